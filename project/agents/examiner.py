@@ -2,7 +2,8 @@
 
 from typing import List, Dict, Optional
 
-from gigachat_api import chat_with_gigachat
+import httpx
+from gigachat_api import chat_with_gigachat_async
 from langsmith import traceable
 
 
@@ -39,7 +40,13 @@ EXAMINER_PROMPT = (
 )
 
 @traceable(name="examiner_generate_test")
-def run_examiner(access_token: str, topic: str, materials: Optional[List[Dict]] = None) -> str:
+async def run_examiner(
+    access_token: str,
+    topic: str,
+    materials: Optional[List[Dict]] = None,
+    *,
+    client: Optional[httpx.AsyncClient] = None,
+) -> str:
     """
     Агент-тестировщик.
     Добавляет к сообщению пользователя инструкцию, что модель — Examiner.
@@ -64,7 +71,7 @@ def run_examiner(access_token: str, topic: str, materials: Optional[List[Dict]]
             )
 
     # Используем уже существующую функцию из gigachat_api
-    return chat_with_gigachat(access_token, prompt)
+    return await chat_with_gigachat_async(access_token, prompt, client=client)
  
  
  
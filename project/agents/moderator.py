@@ -1,7 +1,9 @@
 # agents/moderator.py
 
-from typing import Tuple
-from gigachat_api import chat_with_gigachat_messages
+from typing import Optional, Tuple
+
+import httpx
+from gigachat_api import chat_with_gigachat_messages_async
 from langsmith import traceable
 
 
@@ -65,7 +67,12 @@ MODERATOR_PROMPT = (
 )
 
 @traceable(name="moderator_decision")
-def run_moderator(access_token: str, user_message: str) -> Tuple[int, int]:
+async def run_moderator(
+    access_token: str,
+    user_message: str,
+    *,
+    client: Optional[httpx.AsyncClient] = None,
+) -> Tuple[int, int]:
     """
     Вызывает модератора и возвращает (agent_id, change_topic_flag).
     agent_id: 1=Tutor, 2=Examiner, 3=Analyzer, 4=Problem Solver
@@ -76,7 +83,7 @@ def run_moderator(access_token: str, user_message: str) -> Tuple[int, int]:
         {"role": "user", "content": user_message},
     ]
 
-    raw_answer = chat_with_gigachat_messages(access_token, prompt)
+    raw_answer = await chat_with_gigachat_messages_async(access_token, prompt, client=client)
 
     # Ожидаем формат "X Y"
     parts = raw_answer.strip().split()
@@ -1,13 +1,19 @@
 # agents/problem_solver.py
 
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 import json
 
-from gigachat_api import chat_with_gigachat_messages
+import httpx
+from gigachat_api import chat_with_gigachat_messages_async
 from langsmith import traceable
 
 
 
+# Ответы пользователя на вопрос «Понятно ли это?» (сравниваются после casefold)
+YES_WORDS = frozenset({"yes", "y", "да", "ага", "понял", "поняла", "понял.", "поняла."})
+NO_WORDS = frozenset({"no", "n", "нет", "неа", "не", "не понял", "не поняла"})
+
+
 PROBLEM_SOLVER_PROMPT = (
     "Ты — Problem Solver, пошаговый объясняющий ассистент.\n"
     "\n"
@@ -30,7 +36,11 @@ PROBLEM_SOLVER_PROMPT = (
 )
 
 
-def _generate_steps(access_token: str, user_question: str) -> List[str]:
+async def _generate_steps(
+    access_token: str,
+    user_question: str,
+    client: Optional[httpx.AsyncClient] = None,
+) -> List[str]:
     """
     Запрашивает у GigaChat план из 3 шагов и возвращает список строк.
     """
@@ -39,7 +49,7 @@ def _generate_steps(access_token: str, user_question: str) -> List[str]:
         {"role": "user", "content": user_question},
     ]
 
-    raw_answer = chat_with_gigachat_messages(access_token, messages)
+    raw_answer = await chat_with_gigachat_messages_async(access_token, messages, client=client)
 
     # Пытаемся распарсить JSON
     try:
@@ -54,7 +64,12 @@ def _generate_steps(access_token: str, user_question: str) -> List[str]:
     # Фолбэк: если модель не дала JSON — всё равно отдаём один шаг
     return [raw_answer.strip()]
 
-def _simplify_step(access_token: str, topic: str, current_explanation: str) -> str:
+async def _simplify_step(
+    access_token: str,
+    topic: str,
+    current_explanation: str,
+    client: Optional[httpx.AsyncClient] = None,
+) -> str:
     """
     Просим модель объяснить тот же шаг проще, другими словами.
     """
@@ -77,17 +92,22 @@ def _simplify_step(access_token: str, topic: str, current_explanation: str) -> s
         {"role": "user", "content": user_content},
     ]
 
-    new_text = chat_with_gigachat_messages(access_token, messages)
+    new_text = await chat_with_gigachat_messages_async(access_token, messages, client=client)
     return new_text.strip()
 
 @traceable(name="problem_solver_start")
-def start_problem_solver(access_token: str, user_question: str) -> Tuple[str, Dict]:
+async def start_problem_solver(
+    access_token: str,
+    user_question: str,
+    *,
+    client: Optional[httpx.AsyncClient] = None,
+) -> Tuple[str, Dict]:
     """
     Старт Problem Solver-а:
     - запрашивает у модели 3 шага,
     - возвращает текст для пользователя и состояние problem_solver.
     """
-    steps = _generate_steps(access_token, user_question)
+    steps = await _generate_steps(access_token, user_question, client)
 
     # Гарантируем не менее 1 шага
     if not steps:
@@ -110,7 +130,13 @@ def start_problem_solver(access_token: str, user_question: str) -> Tuple[str, Di
     return text, state
 
 @traceable(name="continue_problem_solver")
-def continue_problem_solver(access_token: str, problem_state: Dict, user_reply: str):
+async def continue_problem_solver(
+    access_token: str,
+    problem_state: Dict,
+    user_reply: str,
+    *,
+    client: Optional[httpx.AsyncClient] = None,
+):
     """
     Продолжение Problem Solver-а:
     - если пользователь ответил 'да' → переходим к следующему шагу (или завершаем),
@@ -123,12 +149,10 @@ def continue_problem_solver(access_token: str, problem_state: Dict, user_reply:
     current_step = problem_state.get("current_step", 0)
     topic = problem_state.get("topic", "")
 
-    ans = user_reply.strip().lower()
-    yes_words = {"yes", "y", "да", "ага", "понял", "поняла", "понял.", "поняла."}
-    no_words = {"no", "n", "нет", "неа", "не", "не понял", "не поняла"}
+    ans = user_reply.strip().casefold()
 
     # --- ПОЛЬЗОВАТЕЛЬ СКАЗАЛ "ДА" ---
-    if ans in yes_words:
+    if ans in YES_WORDS:
         current_step += 1
 
         if current_step < len(steps):
@@ -148,10 +172,10 @@ def continue_problem_solver(access_token: str, problem_state: Dict, user_reply:
             return text, problem_state
 
     # --- ПОЛЬЗОВАТЕЛЬ СКАЗАЛ "НЕТ" ---
-    if ans in no_words:
+    if ans in NO_WORDS:
         if 0 <= current_step < len(steps):
             # просим модель переформулировать текущий шаг проще
-            new_expl = _simplify_step(access_token, topic, steps[current_step])
+            new_expl = await _simplify_step(access_token, topic, steps[current_step], client)
             steps[current_step] = new_expl
             problem_state["steps"] = steps
 
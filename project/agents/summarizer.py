@@ -1,6 +1,9 @@
 # agents/summarizer.py
 
-from gigachat_api import chat_with_gigachat_messages
+from typing import AsyncIterator, Dict, List, Optional
+
+import httpx
+from gigachat_api import chat_with_gigachat_messages_stream_async
 
 SUMMARIZER_PROMPT = (
     "You are a Summarizer agent.\n"
@@ -22,13 +25,25 @@ SUMMARIZER_PROMPT = (
     "- ...\n"
 )
 
-def run_summarizer(access_token: str, user_text: str) -> str:
-    """
-    Summarizer agent: takes large text and returns summary + main topics.
-    """
-    messages = [
+def _build_messages(user_text: str) -> List[Dict[str, str]]:
+    return [
         {"role": "system", "content": SUMMARIZER_PROMPT},
         {"role": "user", "content": user_text},
     ]
 
-    return chat_with_gigachat_messages(access_token, messages)
+
+def run_summarizer_stream(
+    access_token: str,
+    user_text: str,
+    *,
+    client: Optional[httpx.AsyncClient] = None,
+) -> AsyncIterator[str]:
+    """
+    Summarizer agent: takes large text and yields summary + main topics
+    in pieces as GigaChat generates them.
+    """
+    return chat_with_gigachat_messages_stream_async(
+        access_token,
+        _build_messages(user_text),
+        client=client,
+    )
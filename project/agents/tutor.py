@@ -1,6 +1,8 @@
 # agents/tutor.py
-from typing import List, Dict, Tuple
-from gigachat_api import chat_with_gigachat_messages
+from typing import List, Dict, Optional, Tuple
+
+import httpx
+from gigachat_api import chat_with_gigachat_messages_async
 from langsmith import traceable
 
 
@@ -24,10 +26,12 @@ TUTOR_PROMPT = (
 )
 
 @traceable(name="tutor_run")
-def run_tutor(
+async def run_tutor(
     access_token: str,
     user_message: str,
     history: List[Dict[str, str]],
+    *,
+    client: Optional[httpx.AsyncClient] = None,
 ) -> Tuple[str, List[Dict[str, str]]]:
     """
     Агент-репетитор с памятью.
@@ -51,7 +55,7 @@ def run_tutor(
     messages.append({"role": "user", "content": user_message})
 
     # 2. Запрос к GigaChat
-    answer = chat_with_gigachat_messages(access_token, messages)
+    answer = await chat_with_gigachat_messages_async(access_token, messages, client=client)
 
     # 3. Обновляем историю: добавляем новый user-вопрос и ответ ассистента
     history.append({"role": "user", "content": user_message})
@@ -1,23 +1,323 @@
-import json
+import atexit
 import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import msgpack
+import orjson
 
 DB_PATH = Path(__file__).resolve().parent.parent / "lumira.db"
 
+# Первое сообщение каждого нового диалога (вставляется триггером trg_dialog_greeting).
+GREETING_TEXT = "Привет! Я готова помочь с учёбой."
+
+
+# Настройки соединения: WAL не блокирует читателей во время записи,
+# synchronous=NORMAL в WAL-режиме делает fsync только на checkpoint.
+CONN_PRAGMAS = (
+    "PRAGMA synchronous = NORMAL;",
+    "PRAGMA temp_store = MEMORY;",
+    "PRAGMA cache_size = -20000;",
+    "PRAGMA mmap_size = 268435456;",
+    "PRAGMA foreign_keys = ON;",
+)
+
+# Размер LRU-кэша скомпилированных запросов в sqlite3 (по умолчанию 128).
+CACHED_STATEMENTS = 256
+
+# --------- SQL ГОРЯЧИХ ЗАПРОСОВ ----------
+# Один и тот же текст запроса попадает в кэш подготовленных выражений sqlite3,
+# поэтому на каждом ходе диалога остаются только bind + step.
+
+SQL_SAVE_TEST_RESULT = """
+INSERT INTO test_results (topic, score, total, percent, user_answers)
+VALUES (?, ?, ?, ?, ?);
+"""
+
+# {where} — фильтр по теме из _topic_filter (для одного фильтра текст запроса
+# всегда одинаковый, так что кэш выражений по-прежнему срабатывает).
+SQL_LOAD_TEST_RESULTS = """
+SELECT id, created_at, topic, score, total, percent, user_answers
+FROM test_results
+{where}
+ORDER BY id {order}
+LIMIT ? OFFSET ?;
+"""
+
+# Суммирование делает сама БД, без выгрузки строк в Python.
+SQL_TEST_STATS = """
+SELECT COUNT(*) AS count, COALESCE(SUM(score), 0) AS correct, COALESCE(SUM(total), 0) AS total
+FROM test_results
+{where};
+"""
+
+# Поиск по теме идёт через FTS5-индекс (trigram сохраняет семантику подстроки).
+SQL_WHERE_TOPIC_FTS = (
+    "WHERE id IN (SELECT rowid FROM test_results_fts WHERE test_results_fts MATCH ?)"
+)
+
+# trigram не находит строки короче трёх символов — для них остаётся LIKE.
+FTS_MIN_QUERY_LEN = 3
+
+SQL_WHERE_TOPIC_LIKE = "WHERE topic LIKE ?"
+
+SQL_GET_DIALOG = """
+SELECT id, title, created_at, updated_at, version, state_msgpack
+FROM dialogs
+WHERE id = ?;
+"""
+
+# Неизменившееся состояние не перезаписывается: сравнение байтов делает SQLite,
+# и если оно совпало, страница БД не пачкается и в WAL ничего не пишется.
+SQL_UPDATE_DIALOG_STATE = """
+UPDATE dialogs
+SET state_msgpack = ?1, updated_at = ?2
+WHERE id = ?3 AND state_msgpack IS NOT ?1;
+"""
+
+SQL_ADD_MSG = """
+INSERT INTO dialog_messages (dialog_id, role, content, created_at)
+VALUES (?, ?, ?, ?);
+"""
+
+# Берём последние limit сообщений (с конца индекса), порядок разворачиваем в Python.
+SQL_GET_MESSAGES = """
+SELECT id, role, content, created_at
+FROM dialog_messages
+WHERE dialog_id = ?
+ORDER BY id DESC
+LIMIT ?;
+"""
+
+# RETURNING отдаёт записанную строку тем же запросом, без повторного SELECT.
+SQL_CREATE_DIALOG = """
+INSERT INTO dialogs (title, state_json, state_msgpack)
+VALUES (?, '', ?)
+RETURNING id, title, created_at, updated_at;
+"""
+
+# Полнотекстовый поиск по сообщениям всех диалогов: лучшие совпадения (bm25) сверху.
+SEARCH_LIMIT = 20
+
+SQL_SEARCH_MESSAGES = """
+SELECT m.id, m.dialog_id, m.role, m.content, m.created_at
+FROM dialog_messages_fts f
+JOIN dialog_messages m ON m.id = f.rowid
+WHERE dialog_messages_fts MATCH ?
+ORDER BY bm25(dialog_messages_fts)
+LIMIT ?;
+"""
+
+# То же, но только внутри одного диалога (пользователь Telegram видит лишь свой).
+SQL_SEARCH_DIALOG_MESSAGES = """
+SELECT m.id, m.dialog_id, m.role, m.content, m.created_at
+FROM dialog_messages_fts f
+JOIN dialog_messages m ON m.id = f.rowid
+WHERE dialog_messages_fts MATCH ? AND m.dialog_id = ?
+ORDER BY bm25(dialog_messages_fts)
+LIMIT ?;
+"""
+
+# Страница списка диалогов; курсор — (updated_at, id) последнего диалога
+# предыдущей страницы. Все колонки есть в idx_dialogs_recent.
+DIALOGS_PAGE_SIZE = 50
+
+SQL_LIST_DIALOGS = """
+SELECT id, title, updated_at
+FROM dialogs
+ORDER BY updated_at DESC, id DESC
+LIMIT ?;
+"""
+
+SQL_LIST_DIALOGS_BEFORE = """
+SELECT id, title, updated_at
+FROM dialogs
+WHERE (updated_at, id) < (?, ?)
+ORDER BY updated_at DESC, id DESC
+LIMIT ?;
+"""
+
+SQL_HAS_ANY_DIALOG = "SELECT 1 FROM dialogs LIMIT 1;"
+
+SQL_RENAME_DIALOG = """
+UPDATE dialogs
+SET title = ?, updated_at = ?, version = version + 1
+WHERE id = ?
+RETURNING id, title, updated_at;
+"""
+
+SQL_DELETE_DIALOG = "DELETE FROM dialogs WHERE id = ?;"
+
+SQL_SAVE_MATERIAL = """
+INSERT INTO learned_material (topic, source, content)
+VALUES (?, ?, ?);
+"""
+
+SQL_LOAD_MATERIAL = """
+SELECT id, topic, source, content, created_at
+FROM learned_material
+WHERE topic = ?
+ORDER BY id DESC
+LIMIT ?;
+"""
+
+SQL_LINK_OWNER = """
+INSERT OR IGNORE INTO dialog_owners (dialog_id, provider, external_id)
+VALUES (?, ?, ?);
+"""
+
+SQL_GET_OWNER_DIALOG_ID = """
+SELECT dialog_id
+FROM dialog_owners
+WHERE provider = ? AND external_id = ?;
+"""
+
+
+def _now() -> str:
+    """
+    Текущее время UTC в формате datetime('now') ('YYYY-MM-DD HH:MM:SS').
+    Считается один раз на запись, чтобы created_at сообщения и updated_at диалога совпадали.
+    """
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
 
-def get_conn() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
+
+def pack_state(state: Dict[str, Any]) -> bytes:
+    """
+    Упаковывает состояние диалога в msgpack (хранится в BLOB-колонке state_msgpack).
+    """
+    return msgpack.packb(state, use_bin_type=True)
+
+
+def unpack_state(blob: bytes) -> Dict[str, Any]:
+    # strict_map_key=False: ключи current_test — целые числа
+    return msgpack.unpackb(blob, raw=False, strict_map_key=False)
+
+
+# Один писатель + читатели (WAL): все записи идут через одно соединение под
+# блокировкой, а каждый поток читает через своё read-only соединение.
+# Веб-приложение вызывает хранилище через asyncio.to_thread, т.е. в потоках
+# стандартного ThreadPoolExecutor event loop'а (до min(32, cpu + 4) потоков):
+# потоки переиспользуются, поэтому соединения не открывают файлы .db/-wal/-shm
+# на каждый запрос. Если поток всё же завершился (простаивающий пул, скрипты),
+# его соединение закрывается при следующем открытии нового читателя.
+# В WAL-режиме читатели не ждут писателя и друг друга.
+_WRITE_CONN: Optional[sqlite3.Connection] = None
+_WRITE_LOCK = threading.RLock()
+_LOCAL = threading.local()
+_READ_CONNS: Dict[threading.Thread, sqlite3.Connection] = {}
+_READ_CONNS_LOCK = threading.Lock()
+
+
+def _connect(mode: str) -> sqlite3.Connection:
+    # isolation_level=None: autocommit, транзакции открываем явно в transaction()
+    conn = sqlite3.connect(
+        f"{DB_PATH.resolve().as_uri()}?mode={mode}",
+        uri=True,
+        check_same_thread=False,
+        isolation_level=None,
+        cached_statements=CACHED_STATEMENTS,
+    )
     conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys = ON;")
+    for pragma in CONN_PRAGMAS:
+        conn.execute(pragma)
     return conn
 
 
+def get_write_conn() -> sqlite3.Connection:
+    """
+    Возвращает единственное пишущее соединение (создаёт файл БД при необходимости).
+    Использовать только под _WRITE_LOCK — см. transaction().
+    """
+    global _WRITE_CONN
+    with _WRITE_LOCK:
+        if _WRITE_CONN is None:
+            _WRITE_CONN = _connect("rwc")
+        return _WRITE_CONN
+
+
+def get_read_conn() -> sqlite3.Connection:
+    """
+    Возвращает read-only соединение текущего потока (создаётся при первом обращении).
+    Заодно закрывает соединения уже завершившихся потоков.
+    """
+    conn = getattr(_LOCAL, "conn", None)
+    if conn is None:
+        conn = _connect("ro")
+        _LOCAL.conn = conn
+        with _READ_CONNS_LOCK:
+            for thread in [t for t in _READ_CONNS if not t.is_alive()]:
+                # поток мёртв — соединением больше никто не пользуется
+                _READ_CONNS.pop(thread).close()
+            _READ_CONNS[threading.current_thread()] = conn
+    return conn
+
+
+@atexit.register
+def _close_all() -> None:
+    """
+    Закрывает все соединения (писателя и читателей) при завершении процесса.
+    """
+    global _WRITE_CONN
+    with _READ_CONNS_LOCK:
+        conns = list(_READ_CONNS.values())
+        _READ_CONNS.clear()
+    with _WRITE_LOCK:
+        if _WRITE_CONN is not None:
+            conns.append(_WRITE_CONN)
+            _WRITE_CONN = None
+    for conn in conns:
+        conn.close()
+
+
+@contextmanager
+def _read_conn() -> Iterator[sqlite3.Connection]:
+    """
+    Соединение для чтения: в WAL-режиме читатели не блокируют друг друга и писателя.
+    """
+    yield get_read_conn()
+
+
+@contextmanager
+def transaction() -> Iterator[sqlite3.Connection]:
+    """
+    Пишущая транзакция на соединении писателя: BEGIN IMMEDIATE сразу берёт
+    блокировку записи, на выходе COMMIT (или ROLLBACK при исключении).
+    Вложенные вызовы выполняются внутри уже открытой транзакции, поэтому
+    несколько функций записи можно объединить в один коммит:
+        with transaction():
+            add_dialog_message(...)
+            update_dialog_state(...)
+    """
+    with _WRITE_LOCK:
+        conn = get_write_conn()
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute("BEGIN IMMEDIATE;")
+        try:
+            yield conn
+            conn.execute("COMMIT;")
+        except BaseException:
+            # в т.ч. неудачный COMMIT (SQLITE_BUSY, ошибка диска): иначе соединение
+            # писателя осталось бы в транзакции и следующие transaction() молча
+            # присоединялись бы к ней
+            if conn.in_transaction:
+                conn.execute("ROLLBACK;")
+            raise
+
+
 def init_db() -> None:
     """
     Создаёт таблицы, если их ещё нет.
     """
-    with get_conn() as conn:
+    # journal_mode сохраняется в заголовке файла БД, достаточно выставить один раз
+    # (и только вне транзакции)
+    with _WRITE_LOCK:
+        get_write_conn().execute("PRAGMA journal_mode = WAL;")
+    with transaction() as conn:
         conn.execute("""
         CREATE TABLE IF NOT EXISTS test_results (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -29,11 +329,51 @@ def init_db() -> None:
             user_answers TEXT
         );
         """)
+        fts_exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'test_results_fts';"
+        ).fetchone()
+        conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS test_results_fts USING fts5(
+            topic,
+            content='test_results',
+            content_rowid='id',
+            tokenize='trigram'
+        );
+        """)
+        conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS test_results_fts_ai
+        AFTER INSERT ON test_results
+        BEGIN
+            INSERT INTO test_results_fts (rowid, topic) VALUES (NEW.id, NEW.topic);
+        END;
+        """)
+        conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS test_results_fts_ad
+        AFTER DELETE ON test_results
+        BEGIN
+            INSERT INTO test_results_fts (test_results_fts, rowid, topic)
+            VALUES ('delete', OLD.id, OLD.topic);
+        END;
+        """)
+        conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS test_results_fts_au
+        AFTER UPDATE OF topic ON test_results
+        BEGIN
+            INSERT INTO test_results_fts (test_results_fts, rowid, topic)
+            VALUES ('delete', OLD.id, OLD.topic);
+            INSERT INTO test_results_fts (rowid, topic) VALUES (NEW.id, NEW.topic);
+        END;
+        """)
+        if not fts_exists:
+            # индекс создан на уже заполненной таблице — проиндексировать старые строки
+            conn.execute("INSERT INTO test_results_fts (test_results_fts) VALUES ('rebuild');")
         conn.execute("""
         CREATE TABLE IF NOT EXISTS dialogs (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             title TEXT NOT NULL,
-            state_json TEXT NOT NULL,
+            state_json TEXT NOT NULL DEFAULT '',
+            state_msgpack BLOB,
+            version INTEGER NOT NULL DEFAULT 0,
             created_at TEXT NOT NULL DEFAULT (datetime('now')),
             updated_at TEXT NOT NULL DEFAULT (datetime('now'))
         );
@@ -48,6 +388,80 @@ def init_db() -> None:
             FOREIGN KEY(dialog_id) REFERENCES dialogs(id) ON DELETE CASCADE
         );
         """)
+        msgs_fts_exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'dialog_messages_fts';"
+        ).fetchone()
+        # поиск по словам (без учёта регистра и диакритики, ё/е различаются)
+        conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS dialog_messages_fts USING fts5(
+            content,
+            content='dialog_messages',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        );
+        """)
+        conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS dialog_messages_fts_ai
+        AFTER INSERT ON dialog_messages
+        BEGIN
+            INSERT INTO dialog_messages_fts (rowid, content) VALUES (NEW.id, NEW.content);
+        END;
+        """)
+        conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS dialog_messages_fts_ad
+        AFTER DELETE ON dialog_messages
+        BEGIN
+            INSERT INTO dialog_messages_fts (dialog_messages_fts, rowid, content)
+            VALUES ('delete', OLD.id, OLD.content);
+        END;
+        """)
+        conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS dialog_messages_fts_au
+        AFTER UPDATE OF content ON dialog_messages
+        BEGIN
+            INSERT INTO dialog_messages_fts (dialog_messages_fts, rowid, content)
+            VALUES ('delete', OLD.id, OLD.content);
+            INSERT INTO dialog_messages_fts (rowid, content) VALUES (NEW.id, NEW.content);
+        END;
+        """)
+        if not msgs_fts_exists:
+            conn.execute("INSERT INTO dialog_messages_fts (dialog_messages_fts) VALUES ('rebuild');")
+        _migrate_dialog_state(conn)
+        _add_column_if_missing(conn, "dialogs", "version", "INTEGER NOT NULL DEFAULT 0")
+        # list_dialogs читает страницу прямо из покрывающего индекса (без обращения
+        # к таблице), get_dialog_messages читает диапазон индекса
+        conn.execute("DROP INDEX IF EXISTS idx_dialogs_updated;")
+        conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_dialogs_recent
+        ON dialogs (updated_at DESC, id DESC, title);
+        """)
+        conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_msgs_dialog
+        ON dialog_messages (dialog_id, id);
+        """)
+        # updated_at и version диалога обновляет сама БД при каждом новом сообщении
+        # (version — основа ETag для GET /dialogs/{id}/messages)
+        conn.execute("DROP TRIGGER IF EXISTS trg_touch_dialog;")
+        conn.execute("""
+        CREATE TRIGGER trg_touch_dialog
+        AFTER INSERT ON dialog_messages
+        BEGIN
+            UPDATE dialogs
+            SET updated_at = NEW.created_at, version = version + 1
+            WHERE id = NEW.dialog_id;
+        END;
+        """)
+        # приветствие создаётся вместе с диалогом, без второго запроса из Python;
+        # пересоздаём, чтобы подхватить изменённый GREETING_TEXT
+        conn.execute("DROP TRIGGER IF EXISTS trg_dialog_greeting;")
+        conn.execute(f"""
+        CREATE TRIGGER trg_dialog_greeting
+        AFTER INSERT ON dialogs
+        BEGIN
+            INSERT INTO dialog_messages (dialog_id, role, content, created_at)
+            VALUES (NEW.id, 'assistant', {_sql_literal(GREETING_TEXT)}, NEW.created_at);
+        END;
+        """)
         conn.execute("""
         CREATE TABLE IF NOT EXISTS dialog_owners (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -68,58 +482,116 @@ def init_db() -> None:
             created_at TEXT NOT NULL DEFAULT (datetime('now'))
         );
         """)
-        conn.commit()
+
+
+def _add_column_if_missing(conn: sqlite3.Connection, table: str, column: str, decl: str) -> None:
+    """
+    Добавляет колонку в существующую таблицу (для БД, созданных старой схемой).
+    """
+    columns = {row["name"] for row in conn.execute(f"PRAGMA table_info({table});")}
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl};")
+
+
+def _migrate_dialog_state(conn: sqlite3.Connection) -> None:
+    """
+    Переводит старые диалоги с JSON-состояния (state_json) на msgpack (state_msgpack).
+    """
+    _add_column_if_missing(conn, "dialogs", "state_msgpack", "BLOB")
+
+    legacy = conn.execute(
+        "SELECT id, state_json FROM dialogs WHERE state_msgpack IS NULL;"
+    ).fetchall()
+    for row in legacy:
+        try:
+            state = orjson.loads(row["state_json"])
+        except orjson.JSONDecodeError:
+            state = None
+        conn.execute(
+            "UPDATE dialogs SET state_msgpack = ?, state_json = '' WHERE id = ?;",
+            (pack_state(state), row["id"]),
+        )
+
+
+def _sql_literal(text: str) -> str:
+    """
+    Строковый литерал SQL (для DDL, где параметры ? недоступны).
+    """
+    return "'" + text.replace("'", "''") + "'"
+
+
+def _fts_phrase(text: str) -> str:
+    """
+    Экранирует строку как одну фразу для FTS5 MATCH.
+    """
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _fts_words(text: str) -> str:
+    """
+    Превращает пользовательский запрос в FTS5-запрос: каждое слово — отдельная
+    фраза, слова объединяются через неявный AND (операторы FTS5 не срабатывают).
+    """
+    return " ".join(_fts_phrase(word) for word in text.split())
+
+
+def _topic_filter(topic: Optional[str]) -> Tuple[str, Tuple[str, ...]]:
+    """
+    Возвращает (WHERE-условие, параметры) для фильтра по подстроке в теме.
+    """
+    if not topic:
+        return "", ()
+    if len(topic) >= FTS_MIN_QUERY_LEN:
+        return SQL_WHERE_TOPIC_FTS, (_fts_phrase(topic),)
+    return SQL_WHERE_TOPIC_LIKE, (f"%{topic}%",)
 
 
 def save_test_result(topic: Optional[str], score: int, total: int, percent: int, user_answers: str) -> None:
     """
     Сохраняет один результат теста.
     """
-    with get_conn() as conn:
-        conn.execute("""
-        INSERT INTO test_results (topic, score, total, percent, user_answers)
-        VALUES (?, ?, ?, ?, ?);
-        """, (topic, score, total, percent, user_answers))
-        conn.commit()
-
-
-def load_test_results(limit: int = 100, topic: Optional[str] = None) -> List[Dict]:
-    """
-    Загружает последние результаты тестов.
-    Если topic передан, фильтрует по подстроке в названии темы (LIKE %topic%).
-    """
-    with get_conn() as conn:
-        if topic:
-            pattern = f"%{topic}%"
-            rows = conn.execute("""
-            SELECT id, created_at, topic, score, total, percent, user_answers
-            FROM test_results
-            WHERE topic LIKE ?
-            ORDER BY id DESC
-            LIMIT ?;
-            """, (pattern, limit)).fetchall()
-        else:
-            rows = conn.execute("""
-            SELECT id, created_at, topic, score, total, percent, user_answers
-            FROM test_results
-            ORDER BY id DESC
-            LIMIT ?;
-            """, (limit,)).fetchall()
+    with transaction() as conn:
+        conn.execute(SQL_SAVE_TEST_RESULT, (topic, score, total, percent, user_answers))
 
-    return [dict(r) for r in rows]
+
+def load_test_results(
+    limit: int = 100,
+    topic: Optional[str] = None,
+    offset: int = 0,
+    oldest_first: bool = False,
+) -> List[sqlite3.Row]:
+    """
+    Загружает страницу результатов тестов: по умолчанию — последние, от новых к старым.
+    oldest_first=True сортирует от старых к новым (offset считается с начала истории).
+    Если topic передан, фильтрует по подстроке в названии темы (через FTS5-индекс).
+    Возвращает sqlite3.Row (доступ r["topic"]); dict(r) — если нужен JSON.
+    """
+    where, params = _topic_filter(topic)
+    order = "ASC" if oldest_first else "DESC"
+    with _read_conn() as conn:
+        rows = conn.execute(
+            SQL_LOAD_TEST_RESULTS.format(where=where, order=order),
+            (*params, limit, offset),
+        ).fetchall()
+
+    return rows
 
 
-def calc_average(results: List[Dict]) -> Dict:
+def load_test_stats(topic: Optional[str] = None) -> Dict:
     """
-    Считает средний результат по списку результатов.
+    Считает средний результат по всем тестам (с тем же фильтром по теме) прямо в SQL.
+    Возвращает {"count", "correct", "total", "percent"}.
     """
-    total_correct = sum(r.get("score", 0) for r in results)
-    total_questions = sum(r.get("total", 0) for r in results)
-    avg_percent = int(total_correct / total_questions * 100) if total_questions else 0
+    where, params = _topic_filter(topic)
+    with _read_conn() as conn:
+        row = conn.execute(SQL_TEST_STATS.format(where=where), params).fetchone()
+
+    correct, total = row["correct"], row["total"]
     return {
-        "correct": total_correct,
-        "total": total_questions,
-        "percent": avg_percent
+        "count": row["count"],
+        "correct": correct,
+        "total": total,
+        "percent": int(correct / total * 100) if total else 0,
     }
 
 
@@ -127,122 +599,158 @@ def calc_average(results: List[Dict]) -> Dict:
 
 def create_dialog(title: Optional[str], state: Dict[str, Any]) -> Dict[str, Any]:
     """
-    Создаёт новый диалог и возвращает его данные.
+    Создаёт новый диалог (вместе с приветствием GREETING_TEXT) и возвращает его данные.
     """
     title = title or "Новый диалог"
-    state_json = json.dumps(state, ensure_ascii=False)
-    with get_conn() as conn:
-        cur = conn.execute(
-            """
-            INSERT INTO dialogs (title, state_json)
-            VALUES (?, ?);
-            """,
-            (title, state_json),
-        )
-        dialog_id = cur.lastrowid
-        row = conn.execute(
-            "SELECT id, title, created_at, updated_at FROM dialogs WHERE id = ?;",
-            (dialog_id,),
-        ).fetchone()
+    state_blob = pack_state(state)
+    with transaction() as conn:
+        row = conn.execute(SQL_CREATE_DIALOG, (title, state_blob)).fetchone()
 
     return dict(row)
 
 
-def list_dialogs() -> List[Dict[str, Any]]:
-    with get_conn() as conn:
-        rows = conn.execute(
-            """
-            SELECT id, title, created_at, updated_at
-            FROM dialogs
-            ORDER BY updated_at DESC, id DESC;
-            """
-        ).fetchall()
+def list_dialogs(
+    limit: int = DIALOGS_PAGE_SIZE,
+    before: Optional[Tuple[str, int]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Возвращает страницу диалогов, от недавно обновлённых к старым.
+    before — (updated_at, id) последнего диалога предыдущей страницы.
+    """
+    with _read_conn() as conn:
+        if before is None:
+            rows = conn.execute(SQL_LIST_DIALOGS, (limit,)).fetchall()
+        else:
+            rows = conn.execute(SQL_LIST_DIALOGS_BEFORE, (*before, limit)).fetchall()
     return [dict(r) for r in rows]
 
 
-def get_dialog(dialog_id: int) -> Optional[Dict[str, Any]]:
-    with get_conn() as conn:
-        row = conn.execute(
-            """
-            SELECT id, title, created_at, updated_at, state_json
-            FROM dialogs
-            WHERE id = ?;
-            """,
-            (dialog_id,),
-        ).fetchone()
+def has_any_dialog() -> bool:
+    """
+    Есть ли в БД хотя бы один диалог (без чтения самих строк).
+    """
+    with _read_conn() as conn:
+        return conn.execute(SQL_HAS_ANY_DIALOG).fetchone() is not None
+
+
+def get_dialog(dialog_id: int, decode_state: bool = True) -> Optional[Dict[str, Any]]:
+    """
+    Возвращает диалог с состоянием state.
+    decode_state=False — вместо state отдаёт сырые байты state_blob (msgpack),
+    чтобы вызывающий код мог декодировать их сам (например, через кэш).
+    """
+    with _read_conn() as conn:
+        row = conn.execute(SQL_GET_DIALOG, (dialog_id,)).fetchone()
 
     if row is None:
         return None
 
     data = dict(row)
+    if not decode_state:
+        data["state_blob"] = data.pop("state_msgpack")
+        return data
     try:
-        data["state"] = json.loads(data.pop("state_json"))
+        data["state"] = unpack_state(data.pop("state_msgpack"))
     except Exception:
         data["state"] = None
     return data
 
 
 def update_dialog_state(dialog_id: int, state: Dict[str, Any]) -> None:
-    state_json = json.dumps(state, ensure_ascii=False)
-    with get_conn() as conn:
-        conn.execute(
-            """
-            UPDATE dialogs
-            SET state_json = ?, updated_at = datetime('now')
-            WHERE id = ?;
-            """,
-            (state_json, dialog_id),
-        )
-        conn.commit()
+    """
+    Сохраняет состояние диалога, если оно отличается от сохранённого.
+    """
+    state_blob = pack_state(state)
+    with transaction() as conn:
+        conn.execute(SQL_UPDATE_DIALOG_STATE, (state_blob, _now(), dialog_id))
 
 
-def rename_dialog(dialog_id: int, title: str) -> None:
-    with get_conn() as conn:
-        conn.execute(
-            """
-            UPDATE dialogs
-            SET title = ?, updated_at = datetime('now')
-            WHERE id = ?;
-            """,
-            (title, dialog_id),
-        )
-        conn.commit()
+def rename_dialog(dialog_id: int, title: str) -> Optional[Dict[str, Any]]:
+    """
+    Переименовывает диалог и возвращает {id, title, updated_at} (None — диалога нет).
+    """
+    with transaction() as conn:
+        row = conn.execute(SQL_RENAME_DIALOG, (title, _now(), dialog_id)).fetchone()
+    return dict(row) if row else None
 
 
-def delete_dialog(dialog_id: int) -> None:
-    with get_conn() as conn:
-        conn.execute("DELETE FROM dialogs WHERE id = ?;", (dialog_id,))
-        conn.commit()
+def delete_dialog(dialog_id: int) -> int:
+    """
+    Удаляет диалог (сообщения и привязки удаляются каскадом).
+    Возвращает число удалённых строк: 0 — такого диалога не было.
+    """
+    with transaction() as conn:
+        return conn.execute(SQL_DELETE_DIALOG, (dialog_id,)).rowcount
 
 
-def add_dialog_message(dialog_id: int, role: str, content: str) -> None:
-    with get_conn() as conn:
-        conn.execute(
-            """
-            INSERT INTO dialog_messages (dialog_id, role, content)
-            VALUES (?, ?, ?);
-            """,
-            (dialog_id, role, content),
-        )
-        conn.execute(
-            "UPDATE dialogs SET updated_at = datetime('now') WHERE id = ?;",
-            (dialog_id,),
-        )
-        conn.commit()
+def add_dialog_message(dialog_id: int, role: str, content: str) -> str:
+    """
+    Добавляет сообщение и возвращает его created_at (он же новый updated_at диалога).
+    """
+    now = _now()
+    with transaction() as conn:
+        conn.execute(SQL_ADD_MSG, (dialog_id, role, content, now))
+    return now
+
+
+def add_dialog_messages(dialog_id: int, rows: List[Tuple[str, str]]) -> None:
+    """
+    Добавляет сразу несколько сообщений (role, content) одной транзакцией.
+    """
+    if not rows:
+        return
+    now = _now()
+    params = [(dialog_id, role, content, now) for role, content in rows]
+    with transaction() as conn:
+        conn.executemany(SQL_ADD_MSG, params)
+
+
+def persist_chat_turn(
+    dialog_id: int,
+    user_message: str,
+    state: Dict[str, Any],
+    answer: str,
+) -> str:
+    """
+    Сохраняет ход диалога (вопрос, новое состояние, ответ) одной транзакцией —
+    один COMMIT и один fsync WAL на ход. Возвращает новый updated_at диалога.
+    """
+    now = _now()
+    state_blob = pack_state(state)
+    with transaction() as conn:
+        conn.execute(SQL_ADD_MSG, (dialog_id, "user", user_message, now))
+        conn.execute(SQL_UPDATE_DIALOG_STATE, (state_blob, now, dialog_id))
+        conn.execute(SQL_ADD_MSG, (dialog_id, "assistant", answer, now))
+    return now
 
 
 def get_dialog_messages(dialog_id: int, limit: int = 200) -> List[Dict[str, Any]]:
-    with get_conn() as conn:
-        rows = conn.execute(
-            """
-            SELECT id, role, content, created_at
-            FROM dialog_messages
-            WHERE dialog_id = ?
-            ORDER BY id ASC
-            LIMIT ?;
-            """,
-            (dialog_id, limit),
-        ).fetchall()
+    """
+    Возвращает последние limit сообщений диалога в хронологическом порядке.
+    """
+    with _read_conn() as conn:
+        rows = conn.execute(SQL_GET_MESSAGES, (dialog_id, limit)).fetchall()
+    return [dict(r) for r in reversed(rows)]
+
+
+def search_messages(
+    query: str,
+    limit: int = SEARCH_LIMIT,
+    dialog_id: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Ищет сообщения, содержащие все слова запроса (через FTS5-индекс).
+    dialog_id ограничивает поиск одним диалогом.
+    Возвращает {id, dialog_id, role, content, created_at}, самые релевантные первыми.
+    """
+    match = _fts_words(query)
+    if not match:
+        return []
+    with _read_conn() as conn:
+        if dialog_id is None:
+            rows = conn.execute(SQL_SEARCH_MESSAGES, (match, limit)).fetchall()
+        else:
+            rows = conn.execute(SQL_SEARCH_DIALOG_MESSAGES, (match, dialog_id, limit)).fetchall()
     return [dict(r) for r in rows]
 
 
@@ -253,31 +761,15 @@ def save_learned_material(topic: Optional[str], source: str, content: str) -> No
     if not cleaned:
         return
     snippet = cleaned[:1500]
-    with get_conn() as conn:
-        conn.execute(
-            """
-            INSERT INTO learned_material (topic, source, content)
-            VALUES (?, ?, ?);
-            """,
-            (topic, source, snippet),
-        )
-        conn.commit()
+    with transaction() as conn:
+        conn.execute(SQL_SAVE_MATERIAL, (topic, source, snippet))
 
 
 def load_learned_material(topic: Optional[str], limit: int = 5) -> List[Dict[str, Any]]:
     if not topic:
         return []
-    with get_conn() as conn:
-        rows = conn.execute(
-            """
-            SELECT id, topic, source, content, created_at
-            FROM learned_material
-            WHERE topic = ?
-            ORDER BY id DESC
-            LIMIT ?;
-            """,
-            (topic, limit),
-        ).fetchall()
+    with _read_conn() as conn:
+        rows = conn.execute(SQL_LOAD_MATERIAL, (topic, limit)).fetchall()
     return [dict(r) for r in rows]
 
 
@@ -285,32 +777,26 @@ def link_dialog_owner(dialog_id: int, provider: str, external_id: str) -> None:
     """
     Привязывает диалог к внешнему пользователю (например, Telegram).
     """
-    with get_conn() as conn:
-        conn.execute(
-            """
-            INSERT OR IGNORE INTO dialog_owners (dialog_id, provider, external_id)
-            VALUES (?, ?, ?);
-            """,
-            (dialog_id, provider, external_id),
-        )
-        conn.commit()
+    with transaction() as conn:
+        conn.execute(SQL_LINK_OWNER, (dialog_id, provider, external_id))
+
+
+def get_dialog_id_by_owner(provider: str, external_id: str) -> Optional[int]:
+    """
+    Возвращает id диалога внешнего пользователя (None — диалога нет).
+    Для проверки владельца этого достаточно: сам диалог не читается.
+    """
+    with _read_conn() as conn:
+        row = conn.execute(SQL_GET_OWNER_DIALOG_ID, (provider, external_id)).fetchone()
+    return row["dialog_id"] if row else None
 
 
 def get_dialog_by_owner(provider: str, external_id: str) -> Optional[Dict[str, Any]]:
     """
     Возвращает диалог по внешнему идентификатору пользователя.
     """
-    with get_conn() as conn:
-        row = conn.execute(
-            """
-            SELECT dialog_id
-            FROM dialog_owners
-            WHERE provider = ? AND external_id = ?;
-            """,
-            (provider, external_id),
-        ).fetchone()
-
-    if not row:
+    dialog_id = get_dialog_id_by_owner(provider, external_id)
+    if dialog_id is None:
         return None
 
-    return get_dialog(row["dialog_id"])
+    return get_dialog(dialog_id)
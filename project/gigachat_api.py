@@ -1,15 +1,25 @@
 # gigachat_api.py
+import asyncio
 import base64
 import os
-from typing import Optional
+import threading
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator, List, Optional, Tuple, Union
 
+import httpx
+import orjson
 import requests
 import urllib3
 from dotenv import load_dotenv
 from langsmith import traceable
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-load_dotenv()
+# SKIP_DOTENV=1 — переменные уже заданы окружением (тесты, хостинг), .env не читаем.
+if os.getenv("SKIP_DOTENV") != "1":
+    load_dotenv()
 
 
 def _require_env(name: str) -> str:
@@ -23,93 +33,269 @@ def _require_env(name: str) -> str:
 
 
 # ==== НАСТРОЙКИ ====
-CLIENT_ID = _require_env("GIGACHAT_CLIENT_ID")
-CLIENT_SECRET = _require_env("GIGACHAT_CLIENT_SECRET")
-SCOPE = os.getenv("GIGACHAT_SCOPE", "GIGACHAT_API_PERS")
-MODEL = os.getenv("GIGACHAT_MODEL", "GigaChat")
-RQUID = os.getenv("GIGACHAT_RQUID", "fd648f05-0e2b-41bf-8753-5c197c62e598")
+@dataclass(frozen=True)
+class Config:
+    """
+    Настройки GigaChat, читаются из окружения один раз при импорте модуля.
+    """
+    client_id: str
+    client_secret: str
+    scope: str
+    model: str
+    rquid: str
+
+
+CONFIG = Config(
+    client_id=_require_env("GIGACHAT_CLIENT_ID"),
+    client_secret=_require_env("GIGACHAT_CLIENT_SECRET"),
+    scope=os.getenv("GIGACHAT_SCOPE", "GIGACHAT_API_PERS"),
+    model=os.getenv("GIGACHAT_MODEL", "GigaChat"),
+    rquid=os.getenv("GIGACHAT_RQUID", "fd648f05-0e2b-41bf-8753-5c197c62e598"),
+)
+
+
+def _create_session() -> requests.Session:
+    """
+    Общая HTTP-сессия: keep-alive, чтобы не делать TCP+TLS рукопожатие на каждый запрос.
+    """
+    session = requests.Session()
+    session.verify = False
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=Retry(total=2, backoff_factor=0.3),
+    )
+    session.mount("https://", adapter)
+    return session
 
 
-def get_access_token() -> str:
+_SESSION = _create_session()
+
+CHAT_URL = "https://gigachat.devices.sberbank.ru/api/v1/chat/completions"
+
+# Токен живёт ~30 минут; обновляем заранее, за минуту до истечения.
+TOKEN_REFRESH_MARGIN = 60
+DEFAULT_TOKEN_TTL = 1800
+
+_TOKEN: Optional[Tuple[str, float]] = None  # (access_token, expiry unix time)
+_TOKEN_LOCK = threading.Lock()
+
+
+def _fetch_access_token() -> Tuple[str, float]:
     """
-    Получаем OAuth-токен у NGW.
+    Получаем OAuth-токен у NGW. Возвращает (токен, время истечения в unix-секундах).
     """
     url = "https://ngw.devices.sberbank.ru:9443/api/v2/oauth"
 
     # grant_type ОБЯЗАТЕЛЕН
-    payload = f"scope={SCOPE}&grant_type=client_credentials"
+    payload = f"scope={CONFIG.scope}&grant_type=client_credentials"
 
     # client_id:client_secret → base64 (но здесь кладём уже готовые)
-    auth_bytes = f"{CLIENT_ID}:{CLIENT_SECRET}".encode("utf-8")
+    auth_bytes = f"{CONFIG.client_id}:{CONFIG.client_secret}".encode("utf-8")
     auth_b64 = base64.b64encode(auth_bytes).decode("ascii")
 
     headers = {
         "Content-Type": "application/x-www-form-urlencoded",
         "Accept": "application/json",
-        "RqUID": RQUID,
+        "RqUID": CONFIG.rquid,
         "Authorization": f"Basic {auth_b64}",
     }
 
-    resp = requests.post(url, headers=headers, data=payload, verify=False, timeout=30)
+    resp = _SESSION.post(url, headers=headers, data=payload, timeout=30)
     resp.raise_for_status()
-    data = resp.json()
+    data = orjson.loads(resp.content)
+
+    # NGW отдаёт expires_at в миллисекундах; expires_in — на случай другого формата
+    if data.get("expires_at"):
+        expiry = data["expires_at"] / 1000
+    else:
+        expiry = time.time() + data.get("expires_in", DEFAULT_TOKEN_TTL)
 
     # Обычно токен лежит в поле access_token
-    return data["access_token"]
+    return data["access_token"], expiry
 
-def chat_with_gigachat_messages(access_token: str, messages: list[dict]) -> str:
+
+def get_access_token_info(force_refresh: bool = False) -> Tuple[str, float]:
     """
-    Общая функция: отправляет список messages в GigaChat и возвращает ответ ассистента.
-    messages — это список словарей вида {"role": "...", "content": "..."}.
+    Возвращает закэшированный (токен, время истечения), запрашивая новый только ближе к истечению.
     """
-    url = "https://gigachat.devices.sberbank.ru/api/v1/chat/completions"
+    global _TOKEN
+    with _TOKEN_LOCK:
+        if (
+            not force_refresh
+            and _TOKEN is not None
+            and time.time() < _TOKEN[1] - TOKEN_REFRESH_MARGIN
+        ):
+            return _TOKEN
+        _TOKEN = _fetch_access_token()
+        return _TOKEN
 
-    headers = {
+
+def get_access_token(force_refresh: bool = False) -> str:
+    """
+    Возвращает закэшированный OAuth-токен, запрашивая новый только ближе к истечению.
+    """
+    return get_access_token_info(force_refresh)[0]
+
+
+def _refresh_stale_token(stale_token: str) -> str:
+    """
+    Обновляет токен после 401. Если другой поток уже обновил его — берём готовый.
+    """
+    global _TOKEN
+    with _TOKEN_LOCK:
+        if _TOKEN is not None and _TOKEN[0] == stale_token:
+            _TOKEN = None
+    return get_access_token()
+
+
+def _chat_headers(access_token: str, stream: bool = False) -> dict:
+    return {
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json",
-        "Accept": "application/json",
+        "Accept": "text/event-stream" if stream else "application/json",
     }
 
+
+def _chat_payload(messages: list[dict], stream: bool = False) -> dict:
     payload = {
-        "model": MODEL,
+        "model": CONFIG.model,
         "messages": messages,
     }
+    if stream:
+        payload["stream"] = True
+    return payload
 
-    resp = requests.post(url, headers=headers, json=payload, verify=False, timeout=60)
-    resp.raise_for_status()
-    data = resp.json()
 
-    return data["choices"][0]["message"]["content"]
+def _sse_deltas(line: Union[str, bytes]) -> Optional[List[str]]:
+    """
+    Разбирает одну строку SSE-ответа GigaChat и возвращает кусочки текста.
+    Формат событий: "data: {...}", последнее — "data: [DONE]" (тогда возвращается None).
+    """
+    if isinstance(line, str):
+        line = line.encode("utf-8")
+    if not line.startswith(b"data:"):
+        return []
+    data = line[len(b"data:"):].strip()
+    if data == b"[DONE]":
+        return None
+    chunk = orjson.loads(data)
+    return [
+        choice["delta"]["content"]
+        for choice in chunk.get("choices", [])
+        if choice.get("delta", {}).get("content")
+    ]
+
+
+def _friendly_messages(user_message: str) -> list[dict]:
+    return [
+        {
+            "role": "system",
+            "content": "Ты дружелюбный помощник.",
+        },
+        {
+            "role": "user",
+            "content": user_message,
+        },
+    ]
+
 
+# ==== ASYNC-КЛИЕНТ ====
+# Запросы к модели асинхронные и не блокируют event loop веб-сервера на время ответа:
+# пока один диалог ждёт GigaChat, остальные обслуживаются параллельно.
 
-def chat_with_gigachat(access_token: str, user_message: str) -> str:
+ASYNC_CLIENT_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64)
+
+_ASYNC_CLIENT: Optional[httpx.AsyncClient] = None
+
+
+def create_async_client() -> httpx.AsyncClient:
     """
-    Отправляем сообщение в GigaChat и получаем ответ .
+    Новый httpx.AsyncClient для GigaChat: пул keep-alive соединений, HTTP/2 если сервер умеет.
+    Веб-приложение создаёт свой клиент при старте и передаёт его через client=.
     """
-    url = "https://gigachat.devices.sberbank.ru/api/v1/chat/completions"
+    return httpx.AsyncClient(http2=True, verify=False, timeout=60, limits=ASYNC_CLIENT_LIMITS)
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-    }
 
-    payload = {
-        "model": MODEL,
-        "messages": [
-            {
-                "role": "system",
-                "content": "Ты дружелюбный помощник.",
-            },
-            {
-                "role": "user",
-                "content": user_message,
-            },
-        ],
-    }
+def get_async_client() -> httpx.AsyncClient:
+    """
+    Общий клиент модуля — для вызовов без явного client (CLI, скрипты).
+    """
+    global _ASYNC_CLIENT
+    if _ASYNC_CLIENT is None or _ASYNC_CLIENT.is_closed:
+        _ASYNC_CLIENT = create_async_client()
+    return _ASYNC_CLIENT
+
+
+async def chat_with_gigachat_messages_async(
+    access_token: str,
+    messages: list[dict],
+    *,
+    client: Optional[httpx.AsyncClient] = None,
+) -> str:
+    """
+    Отправляет список messages в GigaChat и возвращает ответ ассистента.
+    messages — это список словарей вида {"role": "...", "content": "..."}.
+    При 401 (истёкший токен) один раз повторяет запрос со свежим токеном.
+    """
+    client = client or get_async_client()
+    body = orjson.dumps(_chat_payload(messages))
 
-    resp = requests.post(url, headers=headers, json=payload, verify=False, timeout=60)
+    resp = await client.post(CHAT_URL, headers=_chat_headers(access_token), content=body)
+    if resp.status_code == 401:
+        fresh_token = await asyncio.to_thread(_refresh_stale_token, access_token)
+        resp = await client.post(CHAT_URL, headers=_chat_headers(fresh_token), content=body)
     resp.raise_for_status()
-    data = resp.json()
+    data = orjson.loads(resp.content)
 
     return data["choices"][0]["message"]["content"]
+
+
+async def chat_with_gigachat_messages_stream_async(
+    access_token: str,
+    messages: list[dict],
+    *,
+    client: Optional[httpx.AsyncClient] = None,
+) -> AsyncIterator[str]:
+    """
+    Потоковый вариант chat_with_gigachat_messages_async: GigaChat отвечает SSE-событиями,
+    функция отдаёт кусочки текста ассистента по мере их генерации.
+    """
+    client = client or get_async_client()
+    body = orjson.dumps(_chat_payload(messages, stream=True))
+
+    token = access_token
+    for attempt in range(2):
+        async with client.stream(
+            "POST",
+            CHAT_URL,
+            headers=_chat_headers(token, stream=True),
+            content=body,
+        ) as resp:
+            if resp.status_code == 401 and attempt == 0:
+                token = await asyncio.to_thread(_refresh_stale_token, token)
+                continue
+            resp.raise_for_status()
+            async for line in resp.aiter_lines():
+                deltas = _sse_deltas(line)
+                if deltas is None:
+                    return
+                for delta in deltas:
+                    yield delta
+            return
+
+
+async def chat_with_gigachat_async(
+    access_token: str,
+    user_message: str,
+    *,
+    client: Optional[httpx.AsyncClient] = None,
+) -> str:
+    """
+    Отправляем сообщение в GigaChat и получаем ответ.
+    """
+    return await chat_with_gigachat_messages_async(
+        access_token,
+        _friendly_messages(user_message),
+        client=client,
+    )
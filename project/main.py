@@ -1,28 +1,30 @@
 # main.py
-from dotenv import load_dotenv
-load_dotenv()
-
-
-from gigachat_api import get_access_token, chat_with_gigachat, chat_with_gigachat_messages
+# .env загружается один раз в gigachat_api при импорте
+from gigachat_api import get_access_token
 # SQLite storage
 from db.sqlite_store import (
     init_db,
     save_test_result,
     load_test_results,
-    calc_average,
+    load_test_stats,
     save_learned_material,
     load_learned_material,
+    unpack_state,
 )
+import asyncio
+import copy
 import re
-from typing import Optional, Tuple, Dict, Any
+from typing import Optional, Tuple, Dict, Any, AsyncIterable, AsyncIterator
+
+import httpx
 
 # ALL agents which are used
 from agents.moderator import run_moderator
 from agents.tutor import run_tutor
 from agents.examiner import run_examiner
 from agents.analyser import run_analyser 
-from agents.problem_solver import start_problem_solver, continue_problem_solver
-from agents.summarizer import run_summarizer
+from agents.problem_solver import start_problem_solver, continue_problem_solver, YES_WORDS, NO_WORDS
+from agents.summarizer import run_summarizer_stream
 
 
 
@@ -31,53 +33,70 @@ from utils.format_exam import format_exam
 
 
 #ALL memories which are used
+# Шаблон чистого состояния; наружу отдаются только глубокие копии.
+_BASE_STATE: Dict[str, Any] = {
+    "tutor_history": [],
+    "last_topic": None,
+    "current_test": None,
+    "problem_solver": {
+        "active": False,
+        "topic": None,
+        "steps": [],
+        "current_step": 0,
+    },
+}
+
+
 def create_initial_state() -> Dict[str, Any]:
     """
     Создаёт чистое состояние диалога.
     """
-    return {
-        "tutor_history": [],
-        "last_topic": None,
-        "current_test": None,
-        "problem_solver": {
-            "active": False,
-            "topic": None,
-            "steps": [],
-            "current_step": 0,
-        },
-    }
+    return copy.deepcopy(_BASE_STATE)
 
 
 def normalize_state(state: Optional[Dict[str, Any]]) -> Dict[str, Any]:
     """
     Гарантирует наличие всех ключей в состоянии (для старых диалогов).
     """
-    base = create_initial_state()
     if not isinstance(state, dict):
-        return base
+        return create_initial_state()
 
-    for key, default_value in base.items():
+    for key, default_value in _BASE_STATE.items():
         if key not in state:
-            state[key] = default_value
+            state[key] = copy.deepcopy(default_value)
         elif isinstance(default_value, dict):
             # рекурсивно дополняем словари
+            nested_state = state[key]
             for nested_key, nested_default in default_value.items():
-                if nested_key not in state[key]:
-                    state[key][nested_key] = nested_default
+                if nested_key not in nested_state:
+                    nested_state[nested_key] = copy.deepcopy(nested_default)
 
     current_test = state.get("current_test")
     if isinstance(current_test, dict):
         normalized_test: Dict[int, str] = {}
         for key, value in current_test.items():
-            try:
+            # ключи приходят числами (msgpack) или строками (старый JSON)
+            if isinstance(key, int):
+                normalized_test[key] = str(value).upper()
+            elif isinstance(key, str) and key.lstrip("-").isdecimal():
                 normalized_test[int(key)] = str(value).upper()
-            except (ValueError, TypeError):
-                continue
         state["current_test"] = normalized_test if normalized_test else None
 
     return state
 
 
+def load_state(state_blob: Optional[bytes]) -> Dict[str, Any]:
+    """
+    Декодирует состояние диалога из msgpack и нормализует его.
+    """
+    if not state_blob:
+        return create_initial_state()
+    try:
+        return normalize_state(unpack_state(state_blob))
+    except Exception:
+        return create_initial_state()
+
+
 def _parse_progress_command(user_text: str) -> Tuple[bool, Optional[str]]:
     """
     Возвращает (is_progress_command, topic_filter).
@@ -91,17 +110,19 @@ def _parse_progress_command(user_text: str) -> Tuple[bool, Optional[str]]:
     return True, topic_filter
 
 
-def show_progress(topic_filter: Optional[str] = None) -> str:
+def show_progress(topic_filter: Optional[str] = None, limit: int = 200) -> str:
     """
     Показывает историю результатов из SQLite + среднее.
+    Среднее считается в SQL по всем тестам (с тем же фильтром).
     Если передан topic_filter, показывает только результаты по темам,
     где topic содержит эту подстроку.
     Например: progress planets → только темы, где есть 'planets'.
+    Показываются последние limit тестов, от старых к новым.
     """
-    results = load_test_results(limit=200, topic=topic_filter)
+    avg = load_test_stats(topic_filter)
 
     lines = []
-    if not results:
+    if not avg["count"]:
         if topic_filter:
             return f"Пока нет ни одного теста по теме, содержащей: '{topic_filter}'."
         return "Пока нет ни одного завершённого теста."
@@ -111,29 +132,52 @@ def show_progress(topic_filter: Optional[str] = None) -> str:
     else:
         lines.append("История тестов:")
 
-    for i, r in enumerate(reversed(results), start=1):  # показываем от старых к новым
-        topic = r.get("topic") or "(неизвестная тема)"
-        score = r.get("score", 0)
-        total = r.get("total", 0)
-        percent = r.get("percent", 0)
+    results = load_test_results(
+        limit=limit,
+        topic=topic_filter,
+        offset=max(avg["count"] - limit, 0),
+        oldest_first=True,
+    )
+    for i, r in enumerate(results, start=1):
+        topic = r["topic"] or "(неизвестная тема)"
+        score = r["score"]
+        total = r["total"]
+        percent = r["percent"]
         lines.append(f"{i}. Тема: {topic} — результат: {score}/{total} {percent}%")
 
-    avg = calc_average(results)
     lines.append(
         f"\nСредний результат: {avg['correct']}/{avg['total']} {avg['percent']}%"
     )
     return "\n".join(lines)
 
 
+def _sanitize_line(line: str) -> str:
+    stripped = line.lstrip("#").strip()
+    return stripped.replace("**", "")
+
+
 def _sanitize_markdown(text: str) -> str:
     """
     Удаляет Markdown-заголовки и жирные выделения (#, *).
     """
-    sanitized_lines = []
-    for line in text.splitlines():
-        stripped = line.lstrip("#").strip()
-        sanitized_lines.append(stripped.replace("**", ""))
-    return "\n".join(sanitized_lines)
+    return "\n".join(_sanitize_line(line) for line in text.splitlines())
+
+
+async def _sanitize_markdown_stream(chunks: AsyncIterable[str]) -> AsyncIterator[str]:
+    """
+    Потоковый вариант _sanitize_markdown: копит куски до конца строки
+    и отдаёт уже очищенные строки.
+    """
+    buffer = ""
+    first = True
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            yield ("" if first else "\n") + _sanitize_line(line)
+            first = False
+    if buffer:
+        yield ("" if first else "\n") + _sanitize_line(buffer)
 
 
 STOP_PHRASES = {
@@ -211,68 +255,96 @@ def _remember_material(topic: Optional[str], source: str, content: str):
     save_learned_material(topic, source, content)
 
 
-def process_user_message(access_token: str, user_text: str, state: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+async def process_user_message(
+    access_token: str,
+    user_text: str,
+    state: Dict[str, Any],
+    *,
+    client: Optional[httpx.AsyncClient] = None,
+) -> Tuple[str, Dict[str, Any]]:
     """
     Обрабатывает один запрос пользователя и возвращает текст ответа.
     Эту функцию можно вызывать из CLI или из веб-интерфейса.
     """
     state = normalize_state(state)
-
+    chunks = process_user_message_stream(access_token, user_text, state, client=client)
+    answer = "".join([chunk async for chunk in chunks])
+    return answer, state
+
+
+async def process_user_message_stream(
+    access_token: str,
+    user_text: str,
+    state: Dict[str, Any],
+    *,
+    client: Optional[httpx.AsyncClient] = None,
+) -> AsyncIterator[str]:
+    """
+    То же, что process_user_message, но отдаёт ответ кусками по мере готовности
+    (Summarizer стримит ответ GigaChat построчно, остальные агенты — одним куском).
+    state должен быть уже нормализован (normalize_state) — он обновляется на месте.
+    """
     if not user_text:
-        return _sanitize_markdown("Пожалуйста, введите запрос."), state
+        yield _sanitize_markdown("Пожалуйста, введите запрос.")
+        return
 
     if _has_dangerous_content(user_text):
-        return _sanitize_markdown(
+        yield _sanitize_markdown(
             "Запрос отклонён фильтром безопасности. "
             "Попробуйте сформулировать по-другому."
-        ), state
+        )
+        return
 
     if _is_secret_request(user_text):
-        return _sanitize_markdown(
+        yield _sanitize_markdown(
             "Мне нельзя передавать ключи, токены или конфиденциальные данные. "
             "Давайте продолжим учиться!"
-        ), state
+        )
+        return
 
     request_text = user_text.strip()
 
     # Команда прогресса
     is_progress, topic_filter = _parse_progress_command(request_text)
     if is_progress:
-        progress_text = show_progress(topic_filter)
-        return _sanitize_markdown(progress_text), state
+        # SQLite-запросы — в пуле потоков, чтобы не держать event loop веб-сервера
+        progress_text = await asyncio.to_thread(show_progress, topic_filter)
+        yield _sanitize_markdown(progress_text)
+        return
 
     # --- Если активен Problem Solver и пользователь отвечает "да/нет" ---
     if state["problem_solver"]["active"]:
-        normalized = request_text.lower()
-        yes_words = {"yes", "y", "да", "ага", "понял", "поняла", "понял.", "поняла."}
-        no_words = {"no", "n", "нет", "неа", "не", "не понял", "не поняла"}
-
-        if normalized in yes_words or normalized in no_words:
-            answer, state["problem_solver"] = continue_problem_solver(
+        normalized = request_text.casefold()
+        if normalized in YES_WORDS or normalized in NO_WORDS:
+            answer, state["problem_solver"] = await continue_problem_solver(
                 access_token,
                 state["problem_solver"],
                 request_text,
+                client=client,
             )
-            return _sanitize_markdown(answer), state
+            yield _sanitize_markdown(answer)
+            return
 
     # пустой ввод после trim
     if not request_text:
-        return _sanitize_markdown("Пожалуйста, введите запрос."), state
+        yield _sanitize_markdown("Пожалуйста, введите запрос.")
+        return
 
-    agent_id, change_topic = run_moderator(access_token, request_text)
+    agent_id, change_topic = await run_moderator(access_token, request_text, client=client)
 
     if change_topic == 1:
         state["last_topic"] = request_text
 
     if agent_id == 1:
         # ---- TUTOR ----
-        answer, state["tutor_history"] = run_tutor(
+        answer, state["tutor_history"] = await run_tutor(
             access_token,
             request_text,
             state["tutor_history"],
+            client=client,
         )
         topic_for_memory = state.get("last_topic")
-        _remember_material(topic_for_memory, "tutor", answer)
+        await asyncio.to_thread(_remember_material, topic_for_memory, "tutor", answer)
 
     elif agent_id == 2:
         # ---- EXAMINER ----
@@ -290,8 +362,8 @@ def process_user_message(access_token: str, user_text: str, state: Dict[str, Any
         else:
             topic = state["last_topic"]
 
-        materials = load_learned_material(topic, limit=5)
-        raw_test = run_examiner(access_token, topic, materials)
+        materials = await asyncio.to_thread(load_learned_material, topic, limit=5)
+        raw_test = await run_examiner(access_token, topic, materials, client=client)
         questions_text, answers_dict, theme = format_exam(raw_test)
 
         state["last_topic"] = theme
@@ -306,7 +378,8 @@ def process_user_message(access_token: str, user_text: str, state: Dict[str, Any
         else:
             report_text, score, total = run_analyser(state["current_test"], request_text)
             percent = int(score / total * 100) if total > 0 else 0
-            save_test_result(
+            await asyncio.to_thread(
+                save_test_result,
                 topic=state["last_topic"],
                 score=score,
                 total=total,
@@ -318,33 +391,34 @@ def process_user_message(access_token: str, user_text: str, state: Dict[str, Any
 
     elif agent_id == 4:
         # ---- PROBLEM SOLVER ----
-        answer, ps_state = start_problem_solver(access_token, request_text)
+        answer, ps_state = await start_problem_solver(access_token, request_text, client=client)
         state["problem_solver"] = ps_state
         topic_for_memory = state.get("last_topic") or request_text
-        _remember_material(topic_for_memory, "problem_solver", answer)
+        await asyncio.to_thread(_remember_material, topic_for_memory, "problem_solver", answer)
 
     elif agent_id == 5:
         # ---- SUMMARIZER ----
-        answer = run_summarizer(access_token, request_text)
+        parts = []
+        summary = run_summarizer_stream(access_token, request_text, client=client)
+        async for piece in _sanitize_markdown_stream(summary):
+            parts.append(piece)
+            yield piece
         topic_for_memory = state.get("last_topic") or request_text[:100]
-        _remember_material(topic_for_memory, "summarizer", answer)
+        await asyncio.to_thread(
+            _remember_material, topic_for_memory, "summarizer", "".join(parts)
+        )
+        return
     else:
         answer = "Неизвестный режим, модератор вернул странный код."
 
-    return _sanitize_markdown(answer), state
+    yield _sanitize_markdown(answer)
 
 
 
 
 
 
-if __name__ == "__main__":
-    # 1. Берём токен
-    token = get_access_token()
-    # Инициализация SQLite (создание таблиц)
-    init_db()
-    print("\n\nДобро пожаловать в Lumira!\nLumira — это умный учебный помощник, который может объяснять темы, тренировать тебя с помощью тестов, анализировать ответы и помогать решать задачи.")
-
+async def _run_cli(token: str) -> None:
     state = create_initial_state()
 
     while True:
@@ -358,6 +432,17 @@ if __name__ == "__main__":
         if not user_text:
             continue
 
-        answer, state = process_user_message(token, user_text, state)
         print("\nОтвет модели:\n")
-        print(answer)
+        async for chunk in process_user_message_stream(token, user_text, state):
+            print(chunk, end="", flush=True)
+        print()
+
+
+if __name__ == "__main__":
+    # 1. Берём токен
+    token = get_access_token()
+    # Инициализация SQLite (создание таблиц)
+    init_db()
+    print("\n\nДобро пожаловать в Lumira!\nLumira — это умный учебный помощник, который может объяснять темы, тренировать тебя с помощью тестов, анализировать ответы и помогать решать задачи.")
+
+    asyncio.run(_run_cli(token))
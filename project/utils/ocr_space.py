@@ -1,8 +1,13 @@
+import io
 import os
-from typing import Optional
+from typing import BinaryIO, Optional, Union
 
+import orjson
 import requests
 from langsmith import traceable
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+from urllib3.util.retry import Retry
 
 OCR_SPACE_API_KEY = os.getenv("OCR_SPACE_API_KEY")
 OCR_SPACE_API_URL = os.getenv("OCR_SPACE_API_URL", "https://api.ocr.space/parse/image")
@@ -12,31 +17,49 @@ class OCRSpaceError(Exception):
     """Raised when OCR.Space returns an error."""
 
 
+def _create_session() -> requests.Session:
+    """Shared keep-alive session so repeated uploads reuse the TLS connection."""
+    session = requests.Session()
+    session.mount(
+        "https://",
+        HTTPAdapter(max_retries=Retry(total=2, backoff_factor=0.3)),
+    )
+    return session
+
+
+_SESSION = _create_session()
+
+
 @traceable(name="ocr_space_parse")
 def parse_image_with_ocr_space(
     filename: str,
-    content: bytes,
+    content: Union[bytes, BinaryIO],
     language: str = "eng",
     engine: int = 2,
 ) -> str:
     if not OCR_SPACE_API_KEY:
         raise OCRSpaceError("OCR_SPACE_API_KEY is not configured.")
 
-    files = {
-        "file": (filename or "upload", content),
-    }
-    data = {
-        "language": language,
-        "isOverlayRequired": False,
-        "OCREngine": engine,
+    # The multipart body is streamed from the file object instead of being
+    # assembled into a second in-memory copy of the upload.
+    stream = io.BytesIO(content) if isinstance(content, bytes) else content
+    body = MultipartEncoder(
+        fields={
+            "file": (filename or "upload", stream, "application/octet-stream"),
+            "language": language,
+            "isOverlayRequired": str(False),
+            "OCREngine": str(engine),
+        }
+    )
+    headers = {
+        "apikey": OCR_SPACE_API_KEY,
+        "Content-Type": body.content_type,
     }
-    headers = {"apikey": OCR_SPACE_API_KEY}
 
     try:
-        response = requests.post(
+        response = _SESSION.post(
             OCR_SPACE_API_URL,
-            files=files,
-            data=data,
+            data=body,
             headers=headers,
             timeout=60,
         )
@@ -44,7 +67,7 @@ def parse_image_with_ocr_space(
     except requests.RequestException as exc:
         raise OCRSpaceError(f"OCR request failed: {exc}") from exc
 
-    payload = response.json()
+    payload = orjson.loads(response.content)
     if payload.get("IsErroredOnProcessing"):
         errors = payload.get("ErrorMessage") or payload.get("ErrorDetails") or ["Unknown error"]
         if isinstance(errors, list):
@@ -1,76 +1,166 @@
+import asyncio
+import gzip
 import hashlib
 import hmac
-import json
 import logging
 import os
-import urllib.parse
-from typing import Optional
-
-from fastapi import FastAPI, HTTPException, Request, UploadFile
-from fastapi.responses import HTMLResponse
+import re
+import time
+from contextlib import asynccontextmanager
+from operator import itemgetter
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import brotli
+import orjson
+from fast_query_parsers import parse_query_string
+from fastapi import FastAPI, File, Form, HTTPException, Query, Request, Response, UploadFile
+from fastapi.responses import HTMLResponse, ORJSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from starlette.types import Scope
 
 from db.sqlite_store import (
+    DIALOGS_PAGE_SIZE,
+    SEARCH_LIMIT,
     init_db,
     create_dialog,
     list_dialogs,
+    has_any_dialog,
     get_dialog,
     get_dialog_messages,
-    update_dialog_state,
-    add_dialog_message,
     delete_dialog,
     rename_dialog,
     get_dialog_by_owner,
+    get_dialog_id_by_owner,
     link_dialog_owner,
+    persist_chat_turn,
+    search_messages,
+    transaction,
+)
+from gigachat_api import TOKEN_REFRESH_MARGIN, create_async_client, get_access_token_info
+from main import (
+    process_user_message,
+    process_user_message_stream,
+    create_initial_state,
+    load_state,
 )
-from gigachat_api import get_access_token
-from main import process_user_message, create_initial_state, normalize_state
 from utils.ocr_space import parse_image_with_ocr_space, OCRSpaceError
 
 
-logging.basicConfig(level=logging.INFO)
+# LOG_LEVEL=DEBUG включает подробный лог разбора запросов /chat
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger("lumira.web")
 
-ACCESS_TOKEN = get_access_token()
-init_db()
+STATIC_DIR = Path(__file__).resolve().parent / "static"
 
-app = FastAPI(title="Lumira Web API")
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# Ассеты, которые страницы подключают по адресу с хешем содержимого
+# (style.css -> /static/style.<hash>.css): новая версия файла — новый URL,
+# поэтому старый можно кэшировать навсегда.
+HASHED_ASSETS = ("style.css",)
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+HASHED_NAME_RE = re.compile(r"^(?P<stem>.+)\.(?P<hash>[0-9a-f]{16})(?P<ext>\.[A-Za-z0-9]+)$")
+
+
+def _asset_hash(name: str) -> str:
+    return hashlib.blake2s((STATIC_DIR / name).read_bytes(), digest_size=8).hexdigest()
+
+
+ASSET_HASHES = {name: _asset_hash(name) for name in HASHED_ASSETS}
 
-GREETING_TEXT = "Привет! Я готова помочь с учёбой."
-TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
+def _hashed_url(name: str) -> str:
+    stem, ext = os.path.splitext(name)
+    return f"/static/{stem}.{ASSET_HASHES[name]}{ext}"
 
-class ChatRequest(BaseModel):
-    dialog_id: int
-    message: str
 
+class HashedStaticFiles(StaticFiles):
+    """
+    StaticFiles, понимающий имена с хешем: style.<hash>.css отдаётся из style.css
+    с Cache-Control immutable, если хеш совпадает с текущим содержимым файла.
+    Файлы без хеша отдаются как обычно (с ревалидацией по ETag).
+    """
 
-class ChatResponse(BaseModel):
-    answer: str
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        match = HASHED_NAME_RE.match(path)
+        if match is None:
+            return await super().get_response(path, scope)
+        name = match["stem"] + match["ext"]
+        response = await super().get_response(name, scope)
+        if ASSET_HASHES.get(name) == match["hash"] and response.status_code in (200, 304):
+            response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        return response
 
+# Повторная попытка обновить токен, если OAuth-сервер не ответил
+TOKEN_RETRY_DELAY = 30
 
-class CreateDialogRequest(BaseModel):
-    title: Optional[str] = None
 
+class TokenHolder:
+    """
+    Текущий OAuth-токен GigaChat; обновляется фоновой задачей заранее,
+    чтобы запросы /chat никогда не упирались в истёкший токен.
+    """
+    __slots__ = ("value", "exp")
 
-class RenameDialogRequest(BaseModel):
-    title: str
+    def __init__(self) -> None:
+        self.value = ""
+        self.exp = 0.0
 
+    async def refresh(self, force: bool = False) -> None:
+        self.value, self.exp = await asyncio.to_thread(get_access_token_info, force)
+
+
+TOKEN = TokenHolder()
+
+
+async def _refresh_token_loop() -> None:
+    while True:
+        delay = TOKEN.exp - TOKEN_REFRESH_MARGIN - time.time()
+        await asyncio.sleep(max(delay, TOKEN_RETRY_DELAY))
+        try:
+            await TOKEN.refresh(force=True)
+        except Exception:
+            logger.exception("Не удалось обновить токен GigaChat")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Запуск и остановка воркера: схема БД и диалог по умолчанию, токен GigaChat
+    и общий HTTP-клиент создаются один раз на процесс, а не при импорте модуля.
+    """
+    await asyncio.to_thread(init_db)
+    await asyncio.to_thread(ensure_default_dialog)
+    await TOKEN.refresh()
+    refresh_task = asyncio.create_task(_refresh_token_loop())
+    # один пул соединений с GigaChat на всё приложение: TLS-рукопожатие — один раз
+    app.state.http = create_async_client()
+    try:
+        yield
+    finally:
+        refresh_task.cancel()
+        await app.state.http.aclose()
 
-class TelegramSessionRequest(BaseModel):
-    init_data: str
+
+app = FastAPI(title="Lumira Web API", default_response_class=ORJSONResponse, lifespan=lifespan)
+app.mount("/static", HashedStaticFiles(directory=STATIC_DIR), name="static")
+
+
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+# Ключ проверки подписи initData зависит только от токена бота — считаем один раз.
+TELEGRAM_SECRET_KEY = (
+    hashlib.sha256(TELEGRAM_BOT_TOKEN.encode()).digest() if TELEGRAM_BOT_TOKEN else None
+)
 
 
 def create_dialog_with_greeting(
     title: Optional[str] = None,
     owner: Optional[tuple[str, str]] = None,
 ):
-    dialog = create_dialog(title, create_initial_state())
-    add_dialog_message(dialog["id"], "assistant", GREETING_TEXT)
-    if owner:
-        link_dialog_owner(dialog["id"], owner[0], owner[1])
+    # приветствие вставляет триггер в БД; диалог и владелец — один коммит
+    with transaction():
+        dialog = create_dialog(title, create_initial_state())
+        if owner:
+            link_dialog_owner(dialog["id"], owner[0], owner[1])
     return dialog
 
 
@@ -86,15 +176,20 @@ def get_or_create_owner_dialog(
 
 
 def ensure_default_dialog() -> None:
-    if not list_dialogs():
+    if not has_any_dialog():
         create_dialog_with_greeting("Новый диалог")
 
 
-ensure_default_dialog()
+# Сколько секунд после выдачи (auth_date) initData ещё принимается: перехваченная
+# строка не должна работать вечно.
+TELEGRAM_INIT_DATA_MAX_AGE = int(os.getenv("TELEGRAM_INIT_DATA_MAX_AGE", "86400"))
 
 
 def verify_telegram_init_data(init_data: str) -> dict:
-    if not TELEGRAM_BOT_TOKEN:
+    """
+    Проверяет подпись и срок действия initData и возвращает данные пользователя Telegram.
+    """
+    if not TELEGRAM_SECRET_KEY:
         raise HTTPException(
             status_code=500,
             detail="TELEGRAM_BOT_TOKEN не настроен на сервере.",
@@ -102,31 +197,47 @@ def verify_telegram_init_data(init_data: str) -> dict:
     if not init_data:
         raise HTTPException(status_code=400, detail="Пустые данные Telegram.")
 
-    parsed = dict(urllib.parse.parse_qsl(init_data, keep_blank_values=True))
-    init_hash = parsed.pop("hash", None)
+    # один проход по парам: hash и user забираем сразу, остальное — в список для подписи
+    items = []
+    init_hash = user_json = auth_date = None
+    for key, value in parse_query_string(init_data.encode(), "&"):
+        if key == "hash":
+            init_hash = value
+            continue
+        if key == "user":
+            user_json = value
+        elif key == "auth_date":
+            auth_date = value
+        items.append((key, value))
     if not init_hash:
         raise HTTPException(status_code=400, detail="Нет hash в initData.")
-
-    data_check_string = "\n".join(
-        f"{k}={v}" for k, v in sorted(parsed.items())
-    )
-    secret_key = hashlib.sha256(TELEGRAM_BOT_TOKEN.encode()).digest()
-    calculated_hash = hmac.new(
-        secret_key,
-        data_check_string.encode(),
-        hashlib.sha256,
-    ).hexdigest()
-
-    if not hmac.compare_digest(calculated_hash, init_hash):
+    try:
+        received_digest = bytes.fromhex(init_hash)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail="Некорректный hash в initData.") from exc
+
+    items.sort(key=itemgetter(0))
+    # "=".join склеивает пары (ключ, значение) на C-уровне, без f-строки на поле;
+    # в байты строка кодируется один раз целиком
+    data_check_bytes = "\n".join(map("=".join, items)).encode()
+    # сравниваем сырые 32 байта подписи, без перевода в hex
+    expected_digest = hmac.digest(TELEGRAM_SECRET_KEY, data_check_bytes, "sha256")
+
+    if not hmac.compare_digest(expected_digest, received_digest):
         raise HTTPException(status_code=403, detail="Неверная подпись Telegram.")
 
-    user_json = parsed.get("user")
+    # auth_date подписан вместе с остальными полями, поэтому проверяем его после подписи
+    if not auth_date or not auth_date.isdigit():
+        raise HTTPException(status_code=400, detail="Нет auth_date в initData.")
+    if time.time() - int(auth_date) > TELEGRAM_INIT_DATA_MAX_AGE:
+        raise HTTPException(status_code=403, detail="Данные Telegram устарели, перезапустите приложение.")
+
     if not user_json:
         raise HTTPException(status_code=400, detail="Нет user в initData.")
 
     try:
-        user = json.loads(user_json)
-    except json.JSONDecodeError as exc:
+        user = orjson.loads(user_json)
+    except orjson.JSONDecodeError as exc:
         raise HTTPException(status_code=400, detail="Некорректный JSON user.") from exc
 
     return user
@@ -142,675 +253,310 @@ def get_telegram_user_from_request(request: Request) -> Optional[str]:
         raise HTTPException(status_code=400, detail="Некорректные данные Telegram.")
     return user_id
 
-HTML_PAGE = """
-<!DOCTYPE html>
-<html lang="ru">
-<head>
-  <meta charset="UTF-8" />
-  <title>Lumira</title>
-  <link rel="stylesheet" href="/static/style.css" />
-  <script>
-    window.MathJax = {
-      tex: {
-        inlineMath: [['$', '$'], ['\\(', '\\)']],
-        displayMath: [['$$', '$$'], ['\\[', '\\]']],
-      },
-      options: {
-        skipHtmlTags: ['script', 'noscript', 'style', 'textarea', 'pre', 'code'],
-      },
-    };
-  </script>
-  <script async id="MathJax-script" src="https://cdn.jsdelivr.net/npm/mathjax@3/es5/tex-mml-chtml.js"></script>
-</head>
-<body>
-  <div class="layout">
-    <aside class="sidebar">
-      <div class="sidebar-header">
-        <div class="brand">
-          <div class="logo-circle">L</div>
-          <div class="brand-text">
-            <span>Lumira</span>
-            <small>Учебный помощник</small>
-          </div>
-        </div>
-        <button class="primary" id="new-dialog">+ Новый диалог</button>
-      </div>
-      <div class="dialogs-list" id="dialogs-list"></div>
-    </aside>
-
-    <div class="main-area">
-      <header class="main-header">
-        <div>
-          <p class="hint">Активный диалог</p>
-          <h1 id="dialog-title">Lumira</h1>
-        </div>
-        <button id="rename-dialog" class="ghost">Переименовать</button>
-      </header>
-
-      <div class="chat-window" id="chat-window"></div>
-
-      <form id="chat-form" class="input-area" enctype="multipart/form-data">
-        <textarea id="message" name="message" placeholder="Спросите что угодно…"></textarea>
-        <div class="attachment-row">
-          <label class="file-upload">
-            <input type="file" id="attach-file" name="file" accept="image/png,image/jpeg,application/pdf" />
-            <span>📎 Прикрепить файл (PNG/JPEG/PDF)</span>
-          </label>
-          <select id="file-language" name="language">
-            <option value="rus" selected>Русский текст</option>
-            <option value="eng">English text</option>
-            <option value="ukr">Українська</option>
-          </select>
-          <span id="file-name" class="file-name">Файл не выбран</span>
-        </div>
-        <div class="actions">
-          <span class="hint">Shift + Enter — перенос строки</span>
-          <button type="submit">Отправить</button>
-        </div>
-      </form>
-    </div>
-  </div>
-
-  <script>
-    const chatWindow = document.getElementById('chat-window');
-    const dialogsList = document.getElementById('dialogs-list');
-    const messageInput = document.getElementById('message');
-    const form = document.getElementById('chat-form');
-    const newDialogBtn = document.getElementById('new-dialog');
-    const renameDialogBtn = document.getElementById('rename-dialog');
-    const dialogTitleEl = document.getElementById('dialog-title');
-    const fileInput = document.getElementById('attach-file');
-    const fileLanguage = document.getElementById('file-language');
-    const fileNameLabel = document.getElementById('file-name');
-
-    let dialogs = [];
-    let activeDialogId = null;
-    let isSending = false;
-
-    if (fileInput && fileNameLabel) {
-      fileInput.addEventListener('change', () => {
-        if (fileInput.files.length > 0) {
-          fileNameLabel.textContent = fileInput.files[0].name;
-        } else {
-          fileNameLabel.textContent = 'Файл не выбран';
-        }
-      });
-    }
-
-    function renderMath(element) {
-      if (window.MathJax?.typesetPromise) {
-        MathJax.typesetPromise([element]).catch(() => {});
-      }
-    }
-
-    function appendMessage(role, text) {
-      const wrapper = document.createElement('div');
-      wrapper.className = `message ${role}`;
-
-      const title = document.createElement('div');
-      title.className = 'message-title';
-      title.textContent = role === 'user' ? 'Вы' : 'Lumira';
-
-      const body = document.createElement('div');
-      body.className = 'message-body';
-      body.textContent = text;
-
-      wrapper.appendChild(title);
-      wrapper.appendChild(body);
-      chatWindow.appendChild(wrapper);
-      chatWindow.scrollTop = chatWindow.scrollHeight;
-      renderMath(body);
-      return body;
-    }
-
-    function renderDialogs() {
-      dialogsList.innerHTML = '';
-      dialogs.forEach((dialog) => {
-        const item = document.createElement('div');
-        item.className = 'dialog-item' + (dialog.id === activeDialogId ? ' active' : '');
-        const updatedLabel = dialog.updated_at ? dialog.updated_at.replace('T', ' ') : '';
-        item.innerHTML = `
-          <div class="dialog-info">
-            <div class="dialog-title-text">${dialog.title}</div>
-            <div class="dialog-date">${updatedLabel}</div>
-          </div>
-          <button class="icon-button" title="Удалить" data-dialog="${dialog.id}">✕</button>
-        `;
-
-        item.addEventListener('click', (event) => {
-          if (event.target.matches('.icon-button')) {
-            return;
-          }
-          if (dialog.id !== activeDialogId) {
-            selectDialog(dialog.id);
-          }
-        });
-
-        const deleteBtn = item.querySelector('.icon-button');
-        deleteBtn.addEventListener('click', async (event) => {
-          event.stopPropagation();
-          await deleteDialog(dialog.id);
-        });
-
-        item.addEventListener('dblclick', async (event) => {
-          event.stopPropagation();
-          const newTitle = prompt('Введите название диалога', dialog.title);
-          if (newTitle && newTitle.trim()) {
-            await renameDialog(dialog.id, newTitle.trim());
-          }
-        });
-
-        dialogsList.appendChild(item);
-      });
-    }
-
-    async function loadDialogs() {
-      const response = await fetch('/dialogs');
-      dialogs = await response.json();
-      if (!dialogs.length) {
-        await createDialog();
-        return;
-      }
-      if (!activeDialogId) {
-        activeDialogId = dialogs[0].id;
-        dialogTitleEl.textContent = dialogs[0].title;
-        await loadMessages(activeDialogId);
-      }
-      renderDialogs();
+# Страницы меняются только при деплое; браузер может держать их час.
+PAGE_CACHE_CONTROL = "public, max-age=3600"
+
+
+def _minify_html(text: str) -> str:
+    """
+    Лёгкая минификация: убирает отступы и пустые строки.
+    Переводы строк сохраняются, поэтому встроенный JS (без точек с запятой
+    в конце строк) и шаблонные строки остаются корректными.
+    """
+    return "\n".join(line.strip() for line in text.splitlines() if line.strip())
+
+
+def _page_variant(body: bytes, etag: str, encoding: str) -> Tuple[str, Response, Response]:
+    """
+    Готовые ответы для одного варианта страницы: (ETag, 200 с телом, пустой 304).
+    Объекты Response собираются один раз и переиспользуются между запросами.
+    """
+    headers = {"Cache-Control": PAGE_CACHE_CONTROL, "Vary": "Accept-Encoding", "ETag": etag}
+    not_modified = Response(status_code=304, headers=headers)
+    if encoding != "identity":
+        headers = {**headers, "Content-Encoding": encoding}
+    ok = Response(body, media_type="text/html; charset=utf-8", headers=headers)
+    return etag, ok, not_modified
+
+
+def _load_page(name: str) -> Dict[str, Tuple[str, Response, Response]]:
+    """
+    Читает HTML-страницу из static/, подставляет адреса ассетов с хешем,
+    минифицирует и один раз сжимает её при старте (brotli и gzip).
+    Возвращает готовые ответы по Content-Encoding ("identity" — без сжатия);
+    ETag — хеш содержимого, у сжатого варианта свой.
+    """
+    text = (STATIC_DIR / name).read_text(encoding="utf-8")
+    for asset in HASHED_ASSETS:
+        text = text.replace(f"/static/{asset}", _hashed_url(asset))
+    raw = _minify_html(text).encode("utf-8")
+    digest = hashlib.blake2b(raw, digest_size=8).hexdigest()
+    return {
+        "identity": _page_variant(raw, f'"{digest}"', "identity"),
+        "gzip": _page_variant(gzip.compress(raw, compresslevel=9), f'"{digest}-gzip"', "gzip"),
+        "br": _page_variant(brotli.compress(raw, quality=11), f'"{digest}-br"', "br"),
     }
 
-    async function selectDialog(id) {
-      activeDialogId = id;
-      const dialog = dialogs.find((d) => d.id === id);
-      if (dialog) {
-        dialogTitleEl.textContent = dialog.title;
-      }
-      renderDialogs();
-      await loadMessages(id);
-    }
-
-    async function loadMessages(id) {
-      chatWindow.innerHTML = '';
-      try {
-        const response = await fetch(`/dialogs/${id}/messages`);
-        if (!response.ok) {
-          chatWindow.textContent = 'Не удалось загрузить сообщения.';
-          return;
-        }
-        const data = await response.json();
-        dialogTitleEl.textContent = data.dialog.title;
-        data.messages.forEach((msg) => {
-          appendMessage(msg.role === 'user' ? 'user' : 'assistant', msg.content);
-        });
-        if (data.messages.length === 0) {
-          appendMessage('assistant', 'Привет! Я готова помочь с учёбой.');
-        }
-      } catch (err) {
-        chatWindow.textContent = 'Ошибка загрузки: ' + err;
-      }
-    }
-
-    async function createDialog() {
-      const response = await fetch('/dialogs', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({}) });
-      const dialog = await response.json();
-      await loadDialogs();
-      await selectDialog(dialog.id);
-    }
-
-    async function deleteDialog(id) {
-      await fetch(`/dialogs/${id}`, { method: 'DELETE' });
-      activeDialogId = null;
-      await loadDialogs();
-    }
 
-    async function renameDialog(id, title) {
-      await fetch(`/dialogs/${id}`, {
-        method: 'PATCH',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ title }),
-      });
-      await loadDialogs();
-      await selectDialog(id);
-    }
-
-    form.addEventListener('submit', async (event) => {
-      event.preventDefault();
-      if (isSending) {
-        return;
-      }
-      const userText = messageInput.value.trim();
-      const hasFile = fileInput && fileInput.files.length > 0;
-      const selectedFile = hasFile ? fileInput.files[0] : null;
-      const selectedLanguage = fileLanguage ? fileLanguage.value : 'rus';
-      if (!userText && !hasFile) {
-        return;
-      }
-      if (!activeDialogId) {
-        await createDialog();
-      }
-
-      console.log('Sending chat request', {
-        dialogId: activeDialogId,
-        hasFile: Boolean(selectedFile),
-        fileName: selectedFile?.name || null,
-        fileSize: selectedFile?.size || null,
-        fileType: selectedFile?.type || null,
-        language: selectedLanguage,
-        hasText: Boolean(userText),
-      });
-
-      const fileLabel = selectedFile
-        ? `📎 ${selectedFile.name}`
-        : '';
-      const displayText = userText || fileLabel;
-      appendMessage('user', displayText);
-      messageInput.value = '';
-      const pendingBody = appendMessage('assistant', 'Обработка...');
-
-      isSending = true;
-      try {
-        let response;
-        if (selectedFile) {
-          const formData = new FormData();
-          formData.append('dialog_id', activeDialogId);
-          formData.append('message', userText);
-          formData.append('language', selectedLanguage);
-          formData.append('file', selectedFile, selectedFile.name);
-          response = await fetch('/chat', { method: 'POST', body: formData });
-        } else {
-          response = await fetch('/chat', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ dialog_id: activeDialogId, message: userText }),
-          });
-        }
-
-        if (fileInput) {
-          fileInput.value = '';
-          if (fileNameLabel) {
-            fileNameLabel.textContent = 'Файл не выбран';
-          }
-        }
-
-        const data = await response.json();
-        if (!response.ok) {
-          pendingBody.textContent = data.detail || 'Ошибка запроса.';
-          console.error('Chat request failed', data, response.status);
-        } else {
-          pendingBody.textContent = data.answer;
-          await loadDialogs();
-        }
-        renderMath(pendingBody);
-      } catch (err) {
-        pendingBody.textContent = 'Ошибка подключения: ' + err;
-        renderMath(pendingBody);
-      } finally {
-        isSending = false;
-      }
-    });
-
-    newDialogBtn.addEventListener('click', async () => {
-      await createDialog();
-    });
-
-    renameDialogBtn.addEventListener('click', async () => {
-      if (!activeDialogId) {
-        return;
-      }
-      const current = dialogs.find((d) => d.id === activeDialogId);
-      const title = prompt('Введите название диалога', current ? current.title : '');
-      if (title && title.trim()) {
-        await renameDialog(activeDialogId, title.trim());
-      }
-    });
-
-    messageInput.addEventListener('keydown', (event) => {
-      if (event.key === 'Enter' && !event.shiftKey) {
-        event.preventDefault();
-        form.dispatchEvent(new Event('submit', { cancelable: true }));
-      }
-    });
-
-    loadDialogs();
-  </script>
-</body>
-</html>
-"""
-
-TELEGRAM_PAGE = """
-<!DOCTYPE html>
-<html lang="ru">
-<head>
-  <meta charset="UTF-8" />
-  <meta name="viewport" content="width=device-width, initial-scale=1.0" />
-  <title>Lumira Telegram</title>
-  <script src="https://telegram.org/js/telegram-web-app.js"></script>
-  <script>
-    window.MathJax = window.MathJax || {};
-    window.MathJax.tex = {
-      inlineMath: [['$', '$'], ['\\(', '\\)']],
-      displayMath: [['$$', '$$'], ['\\[', '\\]']],
-    };
-    window.MathJax.options = {
-      skipHtmlTags: ['script', 'noscript', 'style', 'textarea', 'pre', 'code'],
-    };
-  </script>
-  <script async id="MathJax-script" src="https://cdn.jsdelivr.net/npm/mathjax@3/es5/tex-mml-chtml.js"></script>
-  <style>
-    body {
-      font-family: "Inter", "Segoe UI", system-ui, -apple-system, sans-serif;
-      background: #0a0f1f;
-      margin: 0;
-      color: #f4f6ff;
-      display: flex;
-      flex-direction: column;
-      min-height: 100vh;
-    }
-    .container {
-      flex: 1;
-      display: flex;
-      flex-direction: column;
-      padding: 16px;
-    }
-    .header {
-      margin-bottom: 12px;
-    }
-    .header h1 {
-      margin: 0;
-      font-size: 1.25rem;
-    }
-    .status {
-      font-size: 0.9rem;
-      color: rgba(244, 246, 255, 0.75);
-    }
-    .chat {
-      flex: 1;
-      background: rgba(255, 255, 255, 0.06);
-      border-radius: 18px;
-      padding: 16px;
-      overflow-y: auto;
-      display: flex;
-      flex-direction: column;
-      gap: 14px;
-      box-shadow: inset 0 1px 0 rgba(255, 255, 255, 0.05);
-    }
-    .message {
-      padding: 12px 16px;
-      border-radius: 14px;
-      line-height: 1.4;
-      font-size: 0.95rem;
-      max-width: 90%;
-    }
-    .message.user {
-      align-self: flex-end;
-      background: #4a6cf7;
-    }
-    .message.assistant {
-      align-self: flex-start;
-      background: rgba(255, 255, 255, 0.14);
-    }
-    form {
-      margin-top: 12px;
-      display: flex;
-      gap: 8px;
-    }
-    textarea {
-      flex: 1;
-      border-radius: 14px;
-      border: 1px solid rgba(255, 255, 255, 0.2);
-      background: rgba(10, 15, 31, 0.85);
-      color: #f4f6ff;
-      padding: 12px;
-      resize: none;
-      min-height: 64px;
-      font-size: 0.95rem;
-      font-family: inherit;
-    }
-    button {
-      border: none;
-      border-radius: 14px;
-      padding: 0 20px;
-      background: #4a6cf7;
-      color: #fff;
-      font-weight: 600;
-      font-size: 0.95rem;
-      cursor: pointer;
-    }
-  </style>
-</head>
-<body>
-  <div class="container">
-    <div class="header">
-      <h1>Lumira</h1>
-      <div class="status" id="status">Подключение…</div>
-    </div>
-    <div class="chat" id="tg-chat"></div>
-    <form id="tg-form">
-      <textarea id="tg-message" placeholder="Напишите сообщение…" required></textarea>
-      <button type="submit">Отправить</button>
-    </form>
-  </div>
-
-  <script>
-    const telegram = window.Telegram?.WebApp;
-    if (telegram) {
-      telegram.expand();
-      telegram.disableVerticalSwipes();
-    }
-
-    const statusEl = document.getElementById('status');
-    const chatWindow = document.getElementById('tg-chat');
-    const form = document.getElementById('tg-form');
-    const messageInput = document.getElementById('tg-message');
-
-    let dialogId = null;
-    let isSending = false;
-
-    function renderMath(element) {
-      if (window.MathJax?.typesetPromise) {
-        MathJax.typesetPromise([element]).catch(() => {});
-      }
-    }
-
-    function appendMessage(role, text) {
-      const div = document.createElement('div');
-      div.className = `message ${role}`;
-      div.textContent = text;
-      chatWindow.appendChild(div);
-      chatWindow.scrollTop = chatWindow.scrollHeight;
-      renderMath(div);
-      return div;
-    }
+# brotli сжимает HTML с кириллицей заметно плотнее gzip
+PAGE_ENCODINGS = ("br", "gzip")
+
+
+def _choose_encoding(accept_encoding: str) -> str:
+    """
+    Выбирает сжатие по Accept-Encoding с учётом q-значений: кодировка с q=0
+    (явно или через "*;q=0") не используется. Без подходящей — "identity".
+    """
+    weights: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        token, _, params = part.partition(";")
+        token = token.strip().lower()
+        if not token:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[token] = q
+    for encoding in PAGE_ENCODINGS:
+        if weights.get(encoding, weights.get("*", 0.0)) > 0:
+            return encoding
+    return "identity"
+
+
+def _page_response(page: Dict[str, Tuple[str, Response, Response]], request: Request) -> Response:
+    """
+    Отдаёт заранее сжатый вариант страницы, если клиент его принимает.
+    Если у браузера та же версия (If-None-Match), отвечает пустым 304.
+    """
+    encoding = _choose_encoding(request.headers.get("accept-encoding", ""))
+    etag, ok, not_modified = page[encoding]
+    return not_modified if _etag_matches(request, etag) else ok
+
+
+INDEX_PAGE = _load_page("index.html")
+TELEGRAM_PAGE = _load_page("telegram.html")
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    return request.headers.get("if-none-match") == etag
+
+
+def _not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+
+def _dialog_etag(dialog: dict) -> str:
+    """
+    ETag сообщений диалога по его метаданным (без чтения самих сообщений).
+    """
+    key = f'{dialog["id"]}:{dialog["version"]}:{dialog["created_at"]}:{dialog["updated_at"]}'
+    return f'"d{dialog["id"]}-{hashlib.blake2b(key.encode(), digest_size=8).hexdigest()}"'
+
+
+def _json_with_etag(request: Request, data, etag: Optional[str] = None) -> Response:
+    """
+    JSON-ответ с ETag: если у клиента та же версия (If-None-Match), отдаём пустой 304.
+    Без явного etag он считается по телу ответа.
+    """
+    body = orjson.dumps(data)
+    if etag is None:
+        etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+    if _etag_matches(request, etag):
+        return _not_modified(etag)
+    return Response(
+        body,
+        media_type="application/json",
+        headers={"ETag": etag, "Cache-Control": "no-cache"},
+    )
 
-    async function initTelegramChat() {
-      const initData = telegram?.initData || new URLSearchParams(window.location.search).get('tgWebAppData') || '';
-      window.__tgInitData = initData;
-      try {
-        const response = await fetch('/telegram/session', {
-          method: 'POST',
-          headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify({ init_data: initData }),
-        });
-        if (!response.ok) {
-          const error = await response.json();
-          statusEl.textContent = error.detail || 'Ошибка инициализации.';
-          return;
-        }
-        const data = await response.json();
-        dialogId = data.dialog_id;
-        statusEl.textContent = data.title || 'Готово';
-        await loadMessages();
-      } catch (error) {
-        statusEl.textContent = 'Ошибка подключения: ' + error;
-      }
-    }
 
-    async function loadMessages() {
-      if (!dialogId) {
-        return;
-      }
-      chatWindow.innerHTML = '';
-      const headers = window.__tgInitData
-        ? { 'X-Telegram-Init-Data': window.__tgInitData }
-        : {};
-      const response = await fetch(`/dialogs/${dialogId}/messages`, { headers });
-      if (!response.ok) {
-        statusEl.textContent = 'Не удалось загрузить сообщения.';
-        return;
-      }
-      const data = await response.json();
-      data.messages.forEach((msg) => {
-        appendMessage(msg.role === 'user' ? 'user' : 'assistant', msg.content);
-      });
-      if (data.messages.length === 0) {
-        appendMessage('assistant', 'Привет! Я готова помочь с учёбой.');
-      }
-    }
-
-    form.addEventListener('submit', async (event) => {
-      event.preventDefault();
-      if (isSending || !dialogId) {
-        return;
-      }
-      const text = messageInput.value.trim();
-      if (!text) {
-        return;
-      }
-      appendMessage('user', text);
-      const pending = appendMessage('assistant', 'Обработка…');
-      messageInput.value = '';
-      isSending = true;
-      try {
-        const headers = {
-          'Content-Type': 'application/json',
-        };
-        if (window.__tgInitData) {
-          headers['X-Telegram-Init-Data'] = window.__tgInitData;
-        }
-        const response = await fetch('/chat', {
-          method: 'POST',
-          headers,
-          body: JSON.stringify({ dialog_id: dialogId, message: text }),
-        });
-        const data = await response.json();
-        if (!response.ok) {
-          pending.textContent = data.detail || 'Ошибка запроса.';
-        } else {
-          pending.textContent = data.answer;
-        }
-        renderMath(pending);
-      } catch (error) {
-        pending.textContent = 'Ошибка: ' + error;
-        renderMath(pending);
-      } finally {
-        isSending = false;
-      }
-    });
-
-    messageInput.addEventListener('keydown', (event) => {
-      if (event.key === 'Enter' && !event.shiftKey) {
-        event.preventDefault();
-        form.dispatchEvent(new Event('submit', { cancelable: true }));
-      }
-    });
-
-    initTelegramChat();
-  </script>
-</body>
-</html>
-"""
+async def _json_body(request: Request) -> dict:
+    """
+    Тело запроса как JSON-объект (orjson, без Pydantic-модели: полей мало,
+    нужные проверки делает сам обработчик). Пустое тело — пустой объект.
+    """
+    body = await request.body()
+    if not body:
+        return {}
+    try:
+        payload = orjson.loads(body)
+    except orjson.JSONDecodeError as exc:
+        raise HTTPException(status_code=400, detail="Некорректный JSON.") from exc
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=400, detail="Ожидается JSON-объект.")
+    return payload
+
+
+def _str_field(payload: dict, name: str) -> Optional[str]:
+    """
+    Строковое поле JSON-тела (None, если его нет).
+    """
+    value = payload.get(name)
+    if value is not None and not isinstance(value, str):
+        raise HTTPException(status_code=400, detail=f"Поле {name} должно быть строкой.")
+    return value
+
+
+async def _db(fn, *args, **kwargs):
+    """
+    Выполняет блокирующий вызов SQLite в пуле потоков, не занимая event loop.
+    """
+    return await asyncio.to_thread(fn, *args, **kwargs)
+
+
+async def _check_dialog_owner(request: Request, dialog_id: int) -> None:
+    """
+    Пользователь Telegram-мини-приложения видит только свой диалог.
+    Сравниваются только id: строка диалога уже прочитана вызывающим кодом.
+    """
+    tg_user_id = get_telegram_user_from_request(request)
+    if tg_user_id:
+        owned_id = await _db(get_dialog_id_by_owner, "telegram", tg_user_id)
+        if owned_id != dialog_id:
+            raise HTTPException(status_code=403, detail="Нет доступа к этому диалогу.")
 
 
 @app.get("/", response_class=HTMLResponse)
-def index():
-    return HTML_PAGE
+async def index(request: Request):
+    return _page_response(INDEX_PAGE, request)
 
 
 @app.get("/telegram", response_class=HTMLResponse)
-def telegram_page():
-    return TELEGRAM_PAGE
+async def telegram_page(request: Request):
+    return _page_response(TELEGRAM_PAGE, request)
 
 
 @app.get("/dialogs")
-def read_dialogs():
-    return list_dialogs()
+async def read_dialogs(
+    request: Request,
+    limit: int = Query(DIALOGS_PAGE_SIZE, ge=1, le=200),
+    before: Optional[str] = None,
+    before_id: Optional[int] = None,
+):
+    # курсорная пагинация: before/before_id — updated_at и id последнего диалога страницы
+    cursor = (before, before_id) if before is not None and before_id is not None else None
+    return _json_with_etag(request, await _db(list_dialogs, limit, cursor))
+
+
+@app.get("/search")
+async def search(
+    request: Request,
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(SEARCH_LIMIT, ge=1, le=100),
+):
+    # пользователь Telegram-мини-приложения ищет только в своём диалоге
+    tg_user_id = get_telegram_user_from_request(request)
+    if tg_user_id:
+        owned_id = await _db(get_dialog_id_by_owner, "telegram", tg_user_id)
+        if owned_id is None:
+            return ORJSONResponse([])
+        return ORJSONResponse(await _db(search_messages, q, limit, owned_id))
+    return ORJSONResponse(await _db(search_messages, q, limit))
 
 
 @app.post("/dialogs")
-def create_dialog_endpoint(request: CreateDialogRequest):
-    dialog = create_dialog_with_greeting(request.title)
-    return dialog
+async def create_dialog_endpoint(request: Request):
+    title = _str_field(await _json_body(request), "title")
+    dialog = await _db(create_dialog_with_greeting, title)
+    return ORJSONResponse(dialog)
 
 
 @app.get("/dialogs/{dialog_id}/messages")
-def read_dialog_messages(dialog_id: int, request: Request):
-    dialog = get_dialog(dialog_id)
+async def read_dialog_messages(dialog_id: int, request: Request):
+    dialog = await _db(get_dialog, dialog_id, decode_state=False)
     if not dialog:
         raise HTTPException(status_code=404, detail="Диалог не найден.")
 
-    tg_user_id = get_telegram_user_from_request(request)
-    if tg_user_id:
-        owned = get_dialog_by_owner("telegram", tg_user_id)
-        if not owned or owned["id"] != dialog_id:
-            raise HTTPException(status_code=403, detail="Нет доступа к этому диалогу.")
+    await _check_dialog_owner(request, dialog_id)
 
-    messages = get_dialog_messages(dialog_id)
-    return {"dialog": {"id": dialog["id"], "title": dialog["title"]}, "messages": messages}
+    # version растёт с каждым сообщением и переименованием — тело можно не собирать;
+    # created_at/updated_at отличают диалог с тем же id и version из пересозданной БД
+    etag = _dialog_etag(dialog)
+    if _etag_matches(request, etag):
+        return _not_modified(etag)
+
+    messages = await _db(get_dialog_messages, dialog_id)
+    return _json_with_etag(
+        request,
+        {"dialog": {"id": dialog["id"], "title": dialog["title"]}, "messages": messages},
+        etag=etag,
+    )
 
 
 @app.delete("/dialogs/{dialog_id}")
-def remove_dialog(dialog_id: int):
-    dialog = get_dialog(dialog_id)
-    if not dialog:
+async def remove_dialog(dialog_id: int):
+    if not await _db(delete_dialog, dialog_id):
         raise HTTPException(status_code=404, detail="Диалог не найден.")
-    delete_dialog(dialog_id)
-    ensure_default_dialog()
-    return {"status": "ok"}
+    await _db(ensure_default_dialog)
+    return ORJSONResponse({"status": "ok"})
 
 
 @app.patch("/dialogs/{dialog_id}")
-def rename_dialog_endpoint(dialog_id: int, request: RenameDialogRequest):
-    dialog = get_dialog(dialog_id)
+async def rename_dialog_endpoint(dialog_id: int, request: Request):
+    title = _str_field(await _json_body(request), "title")
+    if title is None:
+        raise HTTPException(status_code=400, detail="Не указано название.")
+    dialog = await _db(rename_dialog, dialog_id, title.strip() or "Без названия")
     if not dialog:
         raise HTTPException(status_code=404, detail="Диалог не найден.")
-    rename_dialog(dialog_id, request.title.strip() or "Без названия")
-    return {"status": "ok"}
+    return ORJSONResponse({"status": "ok", "dialog": dialog})
 
 
 @app.post("/telegram/session")
-def telegram_session(request: TelegramSessionRequest):
-    user = verify_telegram_init_data(request.init_data)
+async def telegram_session(request: Request):
+    init_data = _str_field(await _json_body(request), "init_data")
+    user = verify_telegram_init_data(init_data or "")
     user_id = str(user.get("id"))
     if not user_id:
         raise HTTPException(status_code=400, detail="Не удалось определить пользователя.")
 
     title = f"Telegram · {user.get('first_name', '')}".strip() or "Telegram диалог"
-    dialog = get_or_create_owner_dialog("telegram", user_id, title=title)
-    return {"dialog_id": dialog["id"], "title": dialog["title"], "user": user}
+    dialog = await _db(get_or_create_owner_dialog, "telegram", user_id, title=title)
+    return ORJSONResponse({"dialog_id": dialog["id"], "title": dialog["title"], "user": user})
+
+
+# Файлы для OCR: допустимые форматы и лимит размера
+ALLOWED_UPLOAD_TYPES = frozenset({"image/png", "image/jpeg", "image/jpg", "application/pdf"})
+MAX_UPLOAD_SIZE = 5 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
 
 
 async def _process_uploaded_file(file: UploadFile, language: str) -> str:
-    allowed_types = {"image/png", "image/jpeg", "image/jpg", "application/pdf"}
-    if file.content_type not in allowed_types:
+    if file.content_type not in ALLOWED_UPLOAD_TYPES:
         raise HTTPException(status_code=400, detail="Допустимы PNG, JPEG или PDF файлы.")
 
-    content = await file.read()
-    max_size = 5 * 1024 * 1024
-    if len(content) > max_size:
+    # Starlette уже сохранил загрузку во временный файл; размер считаем по кускам,
+    # не собирая весь файл в bytes, и прекращаем чтение, как только лимит превышен
+    size = file.size
+    if size is None:
+        size = 0
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > MAX_UPLOAD_SIZE:
+                break
+        await file.seek(0)
+    if size > MAX_UPLOAD_SIZE:
         raise HTTPException(status_code=400, detail="Файл слишком большой (максимум 5 МБ).")
 
     logger.info(
         "OCR upload: name=%s content_type=%s size=%d lang=%s",
         file.filename,
         file.content_type,
-        len(content),
+        size,
         language,
     )
 
     try:
-        text = parse_image_with_ocr_space(
+        # OCR.Space получает сам файловый объект: тело запроса стримится с диска
+        text = await asyncio.to_thread(
+            parse_image_with_ocr_space,
             file.filename or "upload",
-            content,
+            file.file,
             language=language or "rus",
         )
     except OCRSpaceError as exc:
@@ -828,77 +574,64 @@ async def _process_uploaded_file(file: UploadFile, language: str) -> str:
     return cleaned
 
 
-@app.post("/chat", response_model=ChatResponse)
-async def chat(req: Request):
-    content_type = req.headers.get("content-type", "")
-    dialog_id: Optional[int] = None
-    message = ""
-    upload: Optional[UploadFile] = None
-    language = "rus"
-
-    if content_type.startswith("application/json"):
-        payload = await req.json()
-        data = ChatRequest(**payload)
-        dialog_id = data.dialog_id
-        message = (data.message or "").strip()
-    else:
-        form = await req.form()
-        logger.info("Multipart form keys: %s", list(form.keys()))
-        for key, value in form.multi_items():
-            logger.info(" - %s => %s", key, type(value).__name__)
-        raw_dialog_id = form.get("dialog_id")
-        message = (form.get("message") or "").strip()
-        language = (form.get("language") or "rus").strip() or "rus"
-        candidate = form.get("file")
-        logger.info("Primary file candidate type: %s", type(candidate).__name__)
-        if hasattr(candidate, "filename"):
-            upload = candidate  # treat as UploadFile-like
-        elif "file" in form:
-            possible = form["file"]
-            logger.info("Secondary file lookup type: %s", type(possible).__name__)
-            if hasattr(possible, "filename"):
-                upload = possible
-        if upload is None:
-            file_items = form.getlist("file")
-            logger.info(
-                "getlist('file') types: %s",
-                [type(item).__name__ for item in file_items],
-            )
-            for item in file_items:
-                if hasattr(item, "filename"):
-                    upload = item
-                    break
-        if isinstance(raw_dialog_id, str) and raw_dialog_id.isdigit():
-            dialog_id = int(raw_dialog_id)
-        elif isinstance(raw_dialog_id, int):
-            dialog_id = raw_dialog_id
-
-    if dialog_id is None:
-        raise HTTPException(status_code=400, detail="Не указан dialog_id.")
+def _sse_event(data: dict) -> bytes:
+    return b"data: " + orjson.dumps(data) + b"\n\n"
+
 
+async def _chat_event_stream(dialog_id: int, message: str, state: dict):
+    """
+    Отдаёт ответ ассистента SSE-событиями по мере генерации:
+    {"delta": "..."} … затем {"done": true, "updated_at": "..."} (или {"error": "..."}).
+    Ход диалога сохраняется, когда ответ получен целиком.
+    """
+    parts = []
+    try:
+        async for chunk in process_user_message_stream(
+            TOKEN.value,
+            message,
+            state,
+            client=app.state.http,
+        ):
+            parts.append(chunk)
+            yield _sse_event({"delta": chunk})
+        updated_at = await _db(persist_chat_turn, dialog_id, message, state, "".join(parts))
+    except Exception as exc:
+        logger.exception("Dialog %s: streaming answer failed", dialog_id)
+        yield _sse_event({"error": str(exc)})
+        return
+    yield _sse_event({"done": True, "updated_at": updated_at})
+
+
+async def _chat_reply(
+    req: Request,
+    dialog_id: int,
+    message: str,
+    upload: Optional[UploadFile] = None,
+    language: str = "rus",
+) -> Response:
+    """
+    Общая часть /chat и /chat/upload: проверка доступа, OCR вложения,
+    ответ модели (целиком или потоком SSE) и сохранение хода диалога.
+    """
     if not message and upload is None:
         raise HTTPException(status_code=400, detail="Введите сообщение или прикрепите файл.")
 
-    logger.info(
-        "Chat request dialog=%s type=%s has_file=%s msg_len=%d lang=%s",
-        dialog_id,
-        content_type.split(";")[0],
-        bool(upload),
-        len(message),
-        language,
-    )
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "Chat request dialog=%s has_file=%s msg_len=%d lang=%s",
+            dialog_id,
+            bool(upload),
+            len(message),
+            language,
+        )
 
-    dialog = get_dialog(dialog_id)
+    dialog = await _db(get_dialog, dialog_id, decode_state=False)
     if not dialog:
         raise HTTPException(status_code=404, detail="Диалог не найден.")
 
-    tg_user_id = get_telegram_user_from_request(req)
-    if tg_user_id:
-        owned = get_dialog_by_owner("telegram", tg_user_id)
-        if not owned or owned["id"] != dialog["id"]:
-            raise HTTPException(status_code=403, detail="Нет доступа к этому диалогу.")
+    await _check_dialog_owner(req, dialog_id)
 
-    state = normalize_state(dialog.get("state"))
+    state = load_state(dialog["state_blob"])
 
     if upload is not None:
         ocr_text = await _process_uploaded_file(upload, language)
@@ -917,12 +650,47 @@ async def chat(req: Request):
             len(snippet),
         )
 
+    # Клиенты, принимающие text/event-stream, получают ответ по кусочкам
+    if "text/event-stream" in req.headers.get("accept", ""):
+        return StreamingResponse(
+            _chat_event_stream(dialog_id, message, state),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache"},
+        )
+
     try:
-        add_dialog_message(dialog_id, "user", message)
-        answer, new_state = process_user_message(ACCESS_TOKEN, message, state)
-        update_dialog_state(dialog_id, new_state)
-        add_dialog_message(dialog_id, "assistant", answer)
+        answer, new_state = await process_user_message(
+            TOKEN.value,
+            message,
+            state,
+            client=app.state.http,
+        )
+        updated_at = await _db(persist_chat_turn, dialog_id, message, new_state, answer)
     except Exception as exc:
         raise HTTPException(status_code=500, detail=str(exc))
 
-    return ChatResponse(answer=answer)
+    return ORJSONResponse({"answer": answer, "updated_at": updated_at})
+
+
+@app.post("/chat")
+async def chat(req: Request):
+    payload = await _json_body(req)
+    dialog_id = payload.get("dialog_id")
+    # bool — подкласс int, но id диалога им быть не может
+    if not isinstance(dialog_id, int) or isinstance(dialog_id, bool):
+        raise HTTPException(status_code=400, detail="Не указан dialog_id.")
+    message = (_str_field(payload, "message") or "").strip()
+    return await _chat_reply(req, dialog_id, message)
+
+
+@app.post("/chat/upload")
+async def chat_upload(
+    req: Request,
+    dialog_id: int = Form(...),
+    message: str = Form(""),
+    language: str = Form("rus"),
+    file: Optional[UploadFile] = File(None),
+):
+    # Сообщение с вложением (multipart): поля формы разбирает и проверяет FastAPI
+    upload = file if file is not None and file.filename else None
+    return await _chat_reply(req, dialog_id, message.strip(), upload, language.strip() or "rus")